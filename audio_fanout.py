@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import threading
+
+
+class FanoutConsumer(object):
+    # Single producer, single consumer ring of fixed size frames. The capture thread only moves
+    # write_count and the consumer only moves read_count, so neither side takes a lock. When the
+    # consumer falls capacity frames behind, new frames are dropped for it and counted as
+    # overruns, the other consumers are not held up. An idle consumer waits on the fanout's
+    # condition, which is notified once per captured frame.
+    #
+    # Also an auditok data source, so the tokenizer can read from it like from an ADS.
+    def __init__(self, fanout, capacity_frames):
+        self.fanout = fanout
+        self.capacity_frames = capacity_frames
+        self.frame_bytes = fanout.frame_bytes
+        self.ring = bytearray(self.frame_bytes * capacity_frames)
+        self.lengths = [0] * capacity_frames
+        self.write_count = 0
+        self.read_count = 0
+        self.overruns = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fanout.audio_source, name)
+
+    def write(self, frame):
+        if self.write_count - self.read_count >= self.capacity_frames:
+            self.overruns += 1
+            return
+        slot = self.write_count % self.capacity_frames
+        length = min(len(frame), self.frame_bytes)
+        pos = slot * self.frame_bytes
+        self.ring[pos:pos + length] = frame[:length]
+        self.lengths[slot] = length
+        self.write_count += 1
+
+    def available(self):
+        return self.write_count - self.read_count
+
+    def read(self):
+        # Blocks until a frame is captured, also before capture has started. None once capture
+        # has stopped and the ring is empty
+        if self.read_count == self.write_count:
+            self.fanout.condition.acquire()
+            while self.read_count == self.write_count and not self.fanout.stopped:
+                self.fanout.condition.wait()
+            self.fanout.condition.release()
+            if self.read_count == self.write_count:
+                return None
+        slot = self.read_count % self.capacity_frames
+        pos = slot * self.frame_bytes
+        frame = bytes(self.ring[pos:pos + self.lengths[slot]])
+        self.read_count += 1
+        return frame
+
+    def skip(self):
+        # Drops everything captured so far, used when a consumer only wants audio from now on
+        self.read_count = self.write_count
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def is_open(self):
+        return self.fanout.running
+
+
+class AudioFanout(object):
+    # Reads the capture device once on its own thread and copies every frame into the ring of
+    # each registered consumer. Consumers run on their own threads at their own rate.
+    def __init__(self, audio_source):
+        self.audio_source = audio_source
+        self.frame_bytes = audio_source.get_block_size() * audio_source.get_sample_width() * \
+            audio_source.get_channels()
+        self.frame_duration = float(audio_source.get_block_size()) / audio_source.get_sampling_rate()
+        self.consumers = []
+        self.running = False
+        self.stopped = False
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def add_consumer(self, duration=2.0):
+        consumer = FanoutConsumer(self, max(int(duration / self.frame_duration), 1))
+        self.consumers.append(consumer)
+        return consumer
+
+    def remove_consumer(self, consumer):
+        # The capture thread iterates over the old list, so it is replaced rather than changed
+        self.consumers = [c for c in self.consumers if c is not consumer]
+
+    def start(self):
+        self.running = True
+        self.audio_source.open()
+        self.thread = threading.Thread(target=self.capture)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def capture(self):
+        while self.running:
+            frame = self.audio_source.read()
+            if frame is None:
+                # max_time reached, keep capturing
+                self.audio_source.close()
+                self.audio_source.open()
+                continue
+            for consumer in self.consumers:
+                consumer.write(frame)
+            self.condition.acquire()
+            self.condition.notify_all()
+            self.condition.release()
+
+    def stop(self):
+        self.running = False
+        self.stopped = True
+        self.condition.acquire()
+        self.condition.notify_all()
+        self.condition.release()
+        if self.thread is not None:
+            self.thread.join(1.0)
+        self.audio_source.close()
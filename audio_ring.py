@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import os
+import mmap
+import struct
+import numpy as np
+
+
+class AudioRing(object):
+    # Shared memory ring buffer for passing utterances between co-located modules without
+    # copying them through bottles. The writer places every utterance contiguously (skipping
+    # the tail of the buffer when it would wrap) and announces (offset, length, seq) in a
+    # small bottle. Readers wrap the region with np.frombuffer.
+    #
+    # seq is the running number of bytes written when the utterance was complete. A region is
+    # intact while fewer than capacity bytes have been written after its start.
+    header_size = 64
+
+    def __init__(self, path, capacity=16 * 1024 * 1024, create=False):
+        self.path = path
+        if create:
+            with open(path, 'wb') as f:
+                f.truncate(self.header_size + capacity)
+        self.capacity = os.path.getsize(path) - self.header_size
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        if create:
+            self.set_written(0)
+
+    def get_written(self):
+        return struct.unpack_from('<Q', self.mm, 0)[0]
+
+    def set_written(self, written):
+        struct.pack_into('<Q', self.mm, 0, written)
+
+    def fits(self, frames):
+        return sum([len(f) for f in frames]) <= self.capacity
+
+    def write(self, frames):
+        # frames is a list of byte strings, written straight into the ring without joining
+        length = sum([len(f) for f in frames])
+        if length > self.capacity:
+            raise ValueError("Utterance of " + str(length) + " bytes does not fit in the audio ring")
+        written = self.get_written()
+        offset = written % self.capacity
+        if offset + length > self.capacity:
+            written += self.capacity - offset
+            offset = 0
+        pos = self.header_size + offset
+        for f in frames:
+            self.mm[pos:pos + len(f)] = f
+            pos += len(f)
+        written += length
+        self.set_written(written)
+        return offset, length, written
+
+    def is_intact(self, length, seq):
+        return self.get_written() - (seq - length) <= self.capacity
+
+    def read(self, offset, length, seq, dtype=np.int16):
+        if not self.is_intact(length, seq):
+            return None
+        itemsize = np.dtype(dtype).itemsize
+        return np.frombuffer(self.mm, dtype=dtype, count=length // itemsize, offset=self.header_size + offset)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
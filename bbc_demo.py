@@ -7,17 +7,21 @@ import warnings
 import numpy as np
 import yarp
 import icubclient
-import simplejson
-import requests
 import random
 from enum import Enum
 from os.path import join
 import os
-from pydub import AudioSegment
 from pydub.playback import play
+from pydub.utils import make_chunks
 import re
-from io import BytesIO
-import urllib
+import threading
+import Queue
+from talkml_client import TalkMLClient
+from grammar_matcher import GrammarMatcher
+from timeline_executor import TimelineExecutor
+from tts_cache import TTSCache
+from reply_plan import ReplyPlanCompiler
+from turn_trace import TurnTracer, find_turn_id, new_turn_id
 
 try:
     from rasa_nlu.config import RasaNLUConfig
@@ -26,6 +30,12 @@ try:
 except ImportError:
     use_rasa_grammar = False
 
+try:
+    import pyaudio
+    pyaudio_available = True
+except ImportError:
+    pyaudio_available = False
+
 warnings.simplefilter("ignore")
 np.set_printoptions(precision=2)
 
@@ -45,6 +55,11 @@ class bbc_demo(yarp.RFModule):
         self.num_emotions = None
         self.prepared_action_dict = dict()
         self.duration_action_dict = dict()
+        self.gesture_library = dict()
+        self.timeline = None
+        self.reply_compiler = None
+        self.gesture_offset = 0.0
+        self.emotion_offset = 0.0
         self.attention_on_agent = False
         self.t_last_speak = time.time()
         self.tspeak_timer = 10
@@ -59,8 +74,28 @@ class bbc_demo(yarp.RFModule):
         self.sam_client = None
         self.withProactive = False
         self.use_tacotron = False
+        self.tts = None
+        self.tts_url = "http://localhost:9000/synthesize"
+        self.tts_cache_dir = "/home/icub/user_files/bbc_demo/tts_cache"
+        self.audio_player = None
+        # Playback is written in chunks of this many ms so it can be stopped between them
+        self.playback_chunk = 50
+
+        # Barge-in: the tokenizer keeps listening while the robot speaks and a user utterance
+        # cancels the rest of the reply
+        self.barge_in = False
+        self.robot_speaking = False
+
+        # Spans of the current turn are recorded under the turn id of the utterance it answers.
+        # Replies the robot starts by itself (getSayNext, noinput) get a fresh id
+        self.tracer = None
+        self.turn_id = None
+        self.turn_start = None
         self.planned_reply = ''
+        self.prefetched_reply = None
         self.processed_text = True
+        # False while received_text is a partial hypothesis
+        self.received_final = True
         # Rasa Parameters
         if userasa:
             self.rasa_root_dir = "/home/icub/user_files/bbc_demo/rasa_development/rasa_files"
@@ -78,8 +113,7 @@ class bbc_demo(yarp.RFModule):
         self.chat_interface = "TalkML"
         self.grammar_dict = dict()
         self.detected_grammar = {"g1": '', "g2": ''}
-        self.grammars = dict()
-        self.grammars_mult = dict()
+        self.grammar_matcher = None
         self.TKML_conf_dir = "/home/icub/user_files/bbc_demo/talkml_bbc"
         self.TalkML_tkml_file = join(self.TKML_conf_dir, "TonyInterview_v" + str(version) + ".tkml")
         self.TalkML_grammar_file = join(self.TKML_conf_dir, "TonyInterview_v" + str(version) + ".gmr")
@@ -96,10 +130,22 @@ class bbc_demo(yarp.RFModule):
         self.TalkML_timeout['no_input'] = 7
         self.TalkML_timeout['no_match'] = 4
         self.TalkML_timeout['heard'] = 1.5
+        self.TalkML_deadlines = dict()
+        self.TalkML_deadlines['upload'] = (3.05, 20)
+        self.TalkML_deadlines['start'] = (3.05, 10)
+        self.TalkML_deadlines['heard'] = (3.05, 5)
+        self.TalkML_deadlines['noinput'] = (3.05, 5)
+        self.TalkML_deadlines['nomatch'] = (3.05, 5)
+        self.TalkML_deadlines['getSayNext'] = (3.05, 5)
+        self.TalkML_client = None
         self.TalkML_currState = None
         self.TKML_waitForInput = False
         self.TKML_stop = False
         self.delay_sleep = 0.1
+        self.dialog_events = Queue.Queue()
+        self.dialog_timers = dict()
+        self.expired_timers = set()
+        self.timer_count = 0
         self.tokenizer_delay = 0.3
 
         class TKML_States(Enum):
@@ -142,6 +188,9 @@ class bbc_demo(yarp.RFModule):
         # # ------------------------------------------------------------------------
 
         self.withProactive = rf.find('withProactive').toString_c().lower() == "true"
+        self.barge_in = rf.find('barge_in').toString_c().lower() == "true"
+        trace_val = rf.find('trace_file').toString_c()
+        self.tracer = TurnTracer('bbc_demo', trace_val if trace_val != '' else None)
 
         # Open BBC rpc port
         self.portsList["rpc"] = yarp.Port()
@@ -149,6 +198,7 @@ class bbc_demo(yarp.RFModule):
         self.attach(self.portsList["rpc"])
         yarp.Network.connect("/sentence_tokenizer/audio:o", self.portsList["rpc"].getName())
         # yarp.Network.connect("/deepSpeechToText/text:o", self.portsList["rpc"].getName())
+        yarp.Network.connect("/deepSpeechToText/partial:o", self.portsList["rpc"].getName())
 
         # Open Body control port
         self.portsList["body_control"] = yarp.RpcClient()
@@ -173,13 +223,35 @@ class bbc_demo(yarp.RFModule):
         self.list_of_emotions = ["neutral", "talking", "happy", "sad", "surprised", "evil", "angry", "shy", "cunning"]
         self.num_emotions = len(self.list_of_emotions)
 
+        # Fetch the whole gesture library in one request, falling back to one getDuration per action
+        self.gesture_library = self.get_gesture_library()
         rep = yarp.Bottle()
         for n in self.list_of_actions:
-            rep.clear()
             self.prepared_action_dict[n] = self.prepare_movement(n)
-            cmd = self.prepare_movement(n, duration=True)
-            self.portsList["body_control"].write(cmd, rep)
-            self.duration_action_dict[n] = rep.get(1).asDouble()
+            if n in self.gesture_library.keys():
+                self.duration_action_dict[n] = self.gesture_library[n]['duration']
+            else:
+                rep.clear()
+                cmd = self.prepare_movement(n, duration=True)
+                self.portsList["body_control"].write(cmd, rep)
+                self.duration_action_dict[n] = rep.get(1).asDouble()
+
+        self.reply_compiler = ReplyPlanCompiler(self.prepared_action_dict.keys(), self.list_of_emotions,
+                                                self.gesture_offset, self.emotion_offset)
+
+        if self.use_tacotron:
+            self.tts = TTSCache(self.tts_url, cache_dir=self.tts_cache_dir)
+            # Chunked playback is only needed to stop speech on a barge-in
+            if self.barge_in and pyaudio_available:
+                self.audio_player = pyaudio.PyAudio()
+            elif self.barge_in:
+                print "pyaudio not available. Barge-in cancels speech between segments only"
+
+        # Speech, gestures and emotions of a reply run on parallel tracks
+        self.timeline = TimelineExecutor(lead_track='speech')
+        self.timeline.add_track('speech', self.tacotron_say)
+        self.timeline.add_track('gesture', self.perform_gesture)
+        self.timeline.add_track('emotion', self.perform_emotion)
 
         if self.withProactive:
             self.portsList["toHomeo"] = yarp.Port()
@@ -224,28 +296,12 @@ class bbc_demo(yarp.RFModule):
             self.rasa_interpreter = Interpreter.load(join(self.rasa_root_dir, self.rasa_model_dir),
                                                      self.rasa_config)
         else:
-            with open(self.TalkML_grammar_file) as f:
-                content = f.readlines()
-            # you may also want to remove whitespace characters like `\n` at the end of each line
-            content = [x.strip() for x in content]
-            for j in content:
-                parts = j.split('.*')
-                key = parts[0].replace('\t', '')
-                vals = parts[1][1:-1].split('|')
-                for v in vals:
-                    if "*" in v:
-                        try:
-                            self.grammars_mult[key].append(v.split("*"))
-                        except:
-                            self.grammars_mult[key] = [v.split("*")]
-                    else:
-                        try:
-                            self.grammars[key].append(v)
-                        except:
-                            self.grammars[key] = [v]
+            self.grammar_matcher = GrammarMatcher.from_file(self.TalkML_grammar_file)
 
             # Setting up chat interface
         if self.chat_interface == "TalkML":
+            self.TalkML_client = TalkMLClient(self.TalkML_URL, self.TalkML_headers, self.TalkML_deadlines)
+
             # Reading in tkml file
             with open(self.TalkML_tkml_file, "r") as tkml_file:
                 self.tkml_def = tkml_file.read().replace("\n", " ")
@@ -286,25 +342,20 @@ class bbc_demo(yarp.RFModule):
         return True
 
     def check_grammar(self, grm, text):
-        text = text.lower()
-        b2 = False
-        b1 = False
-
-        if grm in self.grammars.keys():
-            b1 = any(wrd in text for wrd in self.grammars[grm])
-
-        if grm in self.grammars_mult.keys():
-            for k in self.grammars_mult[grm]:
-                b2 = b2 or all(wrd in text for wrd in k)
-
-        if b1 or b2:
-            return True
-        else:
-            return False
+        return self.grammar_matcher.check(grm, text)
 
     def TalkML_Send(self, message):
         print message
-        return requests.post(self.TalkML_URL, data=simplejson.dumps(message), headers=self.TalkML_headers)
+        with self.tracer.span(self.turn_id, 'talkml'):
+            return self.TalkML_client.send(message)
+
+    def TalkML_SendAsync(self, message):
+        print message
+        turn_id = self.turn_id
+        t0 = time.time()
+        future = self.TalkML_client.send_async(message)
+        future.add_done_callback(lambda f: self.tracer.record(turn_id, 'talkml', t0))
+        return future
 
     def freeze_drives(self):
         # Prepare command
@@ -334,12 +385,68 @@ class bbc_demo(yarp.RFModule):
 
         if self.use_tacotron:
             print "Saying", message
-            ret = requests.get("http://localhost:9000/synthesize?text=" + urllib.quote(message))
-            speech_audio = AudioSegment.from_file(BytesIO(ret.content), format="wav")
-            play(speech_audio)
+            with self.tracer.span(self.turn_id, 'tts'):
+                audio = self.tts.get(message)
+            if self.barge_in and audio.dBFS > float('-inf'):
+                self.set_self_speech(True, audio.dBFS)
+            self.record_first_audio()
+            self.play_audio(audio)
         else:
+            # iSpeak cannot be stopped, barge-in takes effect at the next segment
+            self.record_first_audio()
             self.iCub.say(message)
 
+    def record_first_audio(self):
+        # Time from receiving the user's utterance to the first speech of the reply
+        if self.turn_start is not None:
+            self.tracer.record(self.turn_id, 'first_audio', self.turn_start)
+            self.turn_start = None
+
+    def play_audio(self, audio):
+        if self.audio_player is None:
+            play(audio)
+            return
+        stream = self.audio_player.open(format=self.audio_player.get_format_from_width(audio.sample_width),
+                                        channels=audio.channels, rate=audio.frame_rate, output=True)
+        try:
+            for chunk in make_chunks(audio, self.playback_chunk):
+                if self.timeline.is_cancelled():
+                    break
+                stream.write(chunk.raw_data)
+        finally:
+            stream.stop_stream()
+            stream.close()
+
+    def get_gesture_library(self):
+        library = dict()
+        cmd = yarp.Bottle()
+        cmd.addString("listGestures")
+        rep = yarp.Bottle()
+        self.portsList["body_control"].write(cmd, rep)
+        if rep.size() > 0 and rep.get(0).asString() == "ack":
+            for i in range(1, rep.size()):
+                gesture = rep.get(i).asList()
+                parts = gesture.get(1).asList()
+                library[gesture.get(0).asString()] = {'parts': [parts.get(j).asString() for j in range(parts.size())],
+                                                      'duration': gesture.get(2).asDouble()}
+        else:
+            print "listGestures not supported by body_control:", rep.toString()
+        return library
+
+    def perform_gesture(self, action):
+        # Occupies the gesture track for the length of the gesture so gestures do not overlap
+        cmd = yarp.Bottle()
+        cmd.copy(self.prepared_action_dict[action])
+        if self.turn_id is not None:
+            cmd.addString(self.turn_id)
+        rep = yarp.Bottle()
+        with self.tracer.span(self.turn_id, 'gesture_dispatch'):
+            self.portsList["body_control"].write(cmd, rep)
+        self.timeline.sleep(self.duration_action_dict[action])
+
+    def perform_emotion(self, emotion):
+        self.emotion_client.setEmotion(emotion, "all")
+
     def get_chatbot_reply(self, sentence, sendToTKML=False):
         if self.chat_interface == "testing":
             parts = sentence.split(" ")
@@ -390,6 +497,11 @@ class bbc_demo(yarp.RFModule):
                         # message_request += intents['entities']
                 else:
                     print "Grammar parsing: ", sentence
+                    if self.received_final and self.planned_reply == '':
+                        # The final transcript overrides what was matched on partials
+                        self.detected_grammar = {'g1': '', 'g2': ''}
+                    with self.tracer.span(self.turn_id, 'grammar'):
+                        matched_grammars = self.grammar_matcher.match(sentence)
                     message_request = \
                     {
                         "action": currAction,
@@ -399,7 +511,7 @@ class bbc_demo(yarp.RFModule):
                         if self.grammar_dict['g1'] is not None:
                             for g in self.grammar_dict['g1'].split('|'):
                                 if self.detected_grammar['g1'] == '':
-                                    if self.check_grammar(g, sentence):
+                                    if g in matched_grammars:
                                         self.detected_grammar['g1'] = g
                                         self.detected_grammar['g2'] = ''
                                     else:
@@ -411,7 +523,7 @@ class bbc_demo(yarp.RFModule):
                             if self.grammar_dict['g2'] is not None and self.detected_grammar['g1'] == '':
                                 for g in self.grammar_dict['g2'].split('|'):
                                     if self.detected_grammar['g2'] == '':
-                                        if self.check_grammar(g, sentence):
+                                        if g in matched_grammars:
                                             self.detected_grammar['g2'] = g
                                         else:
                                             self.detected_grammar['g2'] = ''
@@ -419,11 +531,10 @@ class bbc_demo(yarp.RFModule):
                                 self.detected_grammar['g2'] = ''
                 print "expecting grammar", self.grammar_dict
                 print "Detected grammar: ",  self.detected_grammar['g1'], "|",  self.detected_grammar['g2']
-                if self.detected_grammar['g1'] != '' and self.planned_reply == '':
+                if self.detected_grammar['g1'] != '' and self.planned_reply == '' and self.received_final:
                     print "Detected g1. Planning reply"
                     message_request['grammar'] = self.detected_grammar['g1']
-                    self.planned_reply = self.TalkML_Send(message_request)
-                    print "received reply", self.planned_reply.json()
+                    self.planned_reply = self.TalkML_SendAsync(message_request)
                 elif sendToTKML:
                     print "sending to tkml"
                     if self.detected_grammar['g2'] != '':
@@ -431,7 +542,8 @@ class bbc_demo(yarp.RFModule):
                     else:
                         message_request['action'] = self.TKML_Actions.nomatch.value
                     this_sentence = self.TalkML_Send(message_request)
-                    print "received reply", this_sentence.json()
+                    if this_sentence is not None:
+                        print "received reply", this_sentence.json()
             else:
                 print sentence, "invalid input"
                 message_request = None
@@ -448,6 +560,21 @@ class bbc_demo(yarp.RFModule):
 
         return this_sentence, True
 
+    def prefetch_reply(self):
+        # getSayNext is only fetched ahead when no grammar is expected, as then nothing the
+        # user says can change the next request and advancing the server early is safe
+        if self.chat_interface == "TalkML" and self.prefetched_reply is None and \
+           not self.TKML_waitForInput and not self.TKML_stop and \
+           self.grammar_dict['g1'] == "" and self.grammar_dict['g2'] == "":
+            print "Prefetching getSayNext"
+            self.prefetched_reply = self.TalkML_SendAsync({"action": self.TKML_Actions.getSayNext.value,
+                                                           "version": "1.0"})
+
+    def commit_prefetched_reply(self):
+        reply = self.prefetched_reply.result()
+        self.prefetched_reply = None
+        return reply
+
     def parse_chatbot_reply(self, reply):
         if str(reply) == "<Response [200]>":
             reply_json = reply.json()
@@ -494,36 +621,46 @@ class bbc_demo(yarp.RFModule):
                 self.TKML_waitForInput = True
                 self.TKML_stop = False
 
+            self.prefetch_reply()
+
             if sayThis is not None and sayThis != "None":
                 self.TalkML_currState = self.TKML_States.TALKING.value
-                sayThis = sayThis.replace("/", "")
-                rep = yarp.Bottle()
-
-                # Turn listening off
-
-                self.toggle_tokenizer()
-                time.sleep(self.tokenizer_delay)
-                compsent = ""
-                for k in sayThis.split(" "):
-                    if "<" not in k or ">" not in k:
-                        compsent += " " + k
-                    elif "gesture" in k:
-                        self.tacotron_say(compsent)
-                        compsent = ""
-                        action = k.replace("<gesture>", "")
-                        self.portsList["body_control"].write(self.prepared_action_dict[action], rep)
-                        time.sleep(self.duration_action_dict[action])
-                    elif "emotion" in k:
-                        self.tacotron_say(compsent)
-                        compsent = ""
-                        em = k.replace("<emotion>", "")
-                        self.emotion_client.setEmotion(em, "all")
-                if compsent != "":
-                    self.tacotron_say(compsent)
-
-                # Turn listening on again
-                time.sleep(self.tokenizer_delay)
-                self.toggle_tokenizer()
+                # A barge-in from here on cancels the reply, also before it starts playing
+                run_token = self.timeline.begin()
+                self.robot_speaking = True
+                try:
+                    timeline = self.reply_compiler.compile(sayThis)
+
+                    # Synthesise upcoming fragments in order while earlier ones are playing
+                    if self.use_tacotron:
+                        for track, value, _ in timeline:
+                            if track == 'speech':
+                                self.tts.prefetch(value)
+
+                    if self.barge_in:
+                        # Keep listening, the tokenizer ignores audio at the level of the robot's voice
+                        self.set_self_speech(True)
+                    else:
+                        # Turn listening off
+                        self.toggle_tokenizer()
+                        time.sleep(self.tokenizer_delay)
+
+                    try:
+                        self.timeline.run(timeline, run_token)
+                    finally:
+                        # Listening is restored even if synthesis or playback failed
+                        self.robot_speaking = False
+                        if self.barge_in:
+                            self.set_self_speech(False)
+                        else:
+                            # Turn listening on again
+                            time.sleep(self.tokenizer_delay)
+                            self.toggle_tokenizer()
+
+                        # Gestures still running finish before the next turn starts
+                        self.timeline.wait()
+                finally:
+                    self.robot_speaking = False
                 return True
             else:
                 print "Reply is empty"
@@ -536,11 +673,27 @@ class bbc_demo(yarp.RFModule):
 
     def close(self):
         print('Exiting ...')
+        self.cancel_timers()
         time.sleep(2)
 
         for j in self.portsList.keys():
             self.close_port(self.portsList[j])
 
+        if self.TalkML_client is not None:
+            self.TalkML_client.close()
+
+        if self.timeline is not None:
+            self.timeline.close()
+
+        if self.tts is not None:
+            self.tts.close()
+
+        if self.tracer is not None:
+            self.tracer.close()
+
+        if self.audio_player is not None:
+            self.audio_player.terminate()
+
         return True
 
     def toggle_tokenizer(self):
@@ -554,6 +707,24 @@ class bbc_demo(yarp.RFModule):
         self.portsList["tokenizer_control"].write(cmd, rep)
         self.tokenizer_state = not self.tokenizer_state
 
+    def set_self_speech(self, speaking, level=None):
+        # level of the speech being played in dBFS, the tokenizer assumes a default without it
+        cmd = yarp.Bottle()
+        cmd.addString("self_speech")
+        if speaking:
+            cmd.addString("on")
+            if level is not None:
+                cmd.addDouble(level)
+        else:
+            cmd.addString("off")
+        rep = yarp.Bottle()
+        self.portsList["tokenizer_control"].write(cmd, rep)
+
+    def cancel_reply(self):
+        # Stops playback within one chunk and drops the gestures and emotions still to come
+        print "Barge-in. Cancelling reply"
+        self.timeline.cancel()
+
     @staticmethod
     def prepare_movement(action_name, delay=None, duration=False):
         cmd = yarp.Bottle()
@@ -584,22 +755,46 @@ class bbc_demo(yarp.RFModule):
         if action == "speaking":
             if command.get(1).asString() == 'start':
                 self.agent_speaking = True
+                if self.barge_in and self.robot_speaking:
+                    self.cancel_reply()
                 print "------------------------waiting for stop speaking"
             else:
                 self.agent_speaking = False
                 print "------------------------stopped speaking"
+            self.dialog_events.put((action,))
             reply.addString('ack')
         # -------------------------------------------------
         if action == "spoken":
-            if command.size() == 2:
+            # spoken <text> [sequence id] [turn id]
+            if command.size() >= 2:
                 self.agent_speaking = False
+                self.turn_id = find_turn_id(command)
+                self.turn_start = time.time()
                 self.received_text = command.get(1).asString()
+                self.received_final = True
                 print "Received sentence", self.received_text
                 self.processed_text = False
+                self.dialog_events.put((action,))
+                reply.addString('ack')
+            else:
+                reply.addString("nack")
+        # -------------------------------------------------
+        elif action == "partial":
+            # Partial hypotheses start grammar matching while the user is still talking, heard is
+            # only sent for the final transcript
+            if command.size() >= 2:
+                self.received_text = command.get(1).asString()
+                self.received_final = False
+                print "Received partial", self.received_text
+                self.processed_text = False
+                self.dialog_events.put((action,))
                 reply.addString('ack')
             else:
                 reply.addString("nack")
         # -------------------------------------------------
+        elif action == "trace_stats":
+            self.tracer.add_stats(reply)
+        # -------------------------------------------------
         elif action == "EXIT":
             reply.addString('ack')
             self.close()
@@ -611,6 +806,8 @@ class bbc_demo(yarp.RFModule):
 
     def interruptModule(self):
         print "Interrupting"
+        self.interrupted = True
+        self.dialog_events.put(('interrupt',))
         self.close()
         return True
 
@@ -621,69 +818,116 @@ class bbc_demo(yarp.RFModule):
     def getPauseValue(start_time):
         return time.time() - start_time
 
+    def next_event(self):
+        # Blocks until respond, a timer or an interrupt posts an event
+        return self.dialog_events.get()
+
+    def start_robot_turn(self):
+        # A reply nobody asked for has no utterance to measure first_audio from
+        self.turn_id = new_turn_id()
+        self.turn_start = None
+
+    def start_timer(self, name, duration):
+        # A timer that fires while being cancelled or replaced may still post its event, the
+        # id makes timer_fired ignore it
+        if name in self.dialog_timers:
+            self.dialog_timers[name][1].cancel()
+        self.timer_count += 1
+        timer = threading.Timer(duration, self.dialog_events.put, args=(('timeout', name, self.timer_count),))
+        timer.daemon = True
+        self.dialog_timers[name] = (self.timer_count, timer)
+        self.expired_timers.discard(name)
+        timer.start()
+
+    def timer_fired(self, event, name):
+        if event[0] == 'timeout' and event[1] == name and name in self.dialog_timers and \
+           self.dialog_timers[name][0] == event[2]:
+            del self.dialog_timers[name]
+            self.expired_timers.add(name)
+            return True
+        return False
+
+    def cancel_timers(self):
+        for _, timer in self.dialog_timers.values():
+            timer.cancel()
+        self.dialog_timers = dict()
+        self.expired_timers = set()
+
     def updateModule(self):
 
         if not self.TKML_waitForInput:
-            start_time = time.time()
             self.detected_grammar = {'g1': '', 'g2': ''}
             self.TalkML_currState = self.TKML_States.WAIT2TALK.value
-            while self.agent_speaking:
+            while self.agent_speaking and not self.interrupted:
                 if not self.processed_text:
                     self.get_chatbot_reply(self.received_text)
                     self.processed_text = True
-                time.sleep(self.delay_sleep)
+                if self.agent_speaking:
+                    self.next_event()
 
-            if self.detected_grammar != {'g1': '', 'g2': ''}:
+            if self.prefetched_reply is not None:
+                # The server has already moved on with getSayNext, its reply is the next one
+                self.start_robot_turn()
+                annotated_reply = self.commit_prefetched_reply()
+            elif self.detected_grammar != {'g1': '', 'g2': ''}:
                 annotated_reply, _ = self.get_chatbot_reply(self.received_text)
             else:
+                self.start_robot_turn()
                 annotated_reply, _ = self.get_chatbot_reply(self.TKML_Actions.getSayNext)
             self.parse_chatbot_reply(annotated_reply)
         else:
             self.TalkML_currState = self.TKML_States.WAIT2HEAR.value
-            start_time = time.time()
-
-            while self.getPauseValue(start_time) < self.TalkML_timeout['no_input'] and \
-                  self.TalkML_currState == self.TKML_States.WAIT2HEAR.value:
-
-                time.sleep(self.delay_sleep)
+            # The previous reply is done, spans until the next utterance belong to no turn
+            self.turn_id = None
+            self.turn_start = None
+            self.start_timer('no_input', self.TalkML_timeout['no_input'])
 
+            while self.TalkML_currState == self.TKML_States.WAIT2HEAR.value and not self.interrupted:
                 if self.agent_speaking:
                     self.TalkML_currState = self.TKML_States.HEARING.value
+                elif self.timer_fired(self.next_event(), 'no_input'):
+                    break
+            self.cancel_timers()
+            if self.interrupted:
+                # Shutting down, nothing is sent to TalkML or said
+                return False
 
             if self.TalkML_currState == self.TKML_States.WAIT2HEAR.value:
 
+                self.start_robot_turn()
                 annotated_reply, _ = self.get_chatbot_reply(self.TKML_Actions.noinput)
                 self.parse_chatbot_reply(annotated_reply)
 
             else:
-                start_time = time.time()
-
-                while self.getPauseValue(start_time) < self.TalkML_timeout['no_match'] and \
-                      self.TalkML_currState == self.TKML_States.HEARING.value:
+                while self.TalkML_currState == self.TKML_States.HEARING.value and not self.interrupted:
 
                     if not self.processed_text:
                         self.get_chatbot_reply(self.received_text)
                         self.processed_text = True
 
-                    time.sleep(self.delay_sleep)
-
-                    # if self.received_text is None and not self.agent_speaking:
-                    #     time.sleep(self.delay_sleep)
-
+                    # no_match and heard count from the moment the user stops speaking
                     if self.agent_speaking:
-                        start_time = time.time()
+                        self.cancel_timers()
+                    elif 'no_match' not in self.dialog_timers:
+                        self.start_timer('no_match', self.TalkML_timeout['no_match'])
+                        self.start_timer('heard', self.TalkML_timeout['heard'])
 
-                    # print self.getPauseValue(start_time), self.TalkML_timeout['heard']
-                    if self.getPauseValue(start_time) > self.TalkML_timeout['heard'] and not\
-                       self.agent_speaking and self.detected_grammar['g1'] != '':
-                        print "inside"
+                    if 'heard' in self.expired_timers and not self.agent_speaking and \
+                       self.detected_grammar['g1'] != '' and self.planned_reply != '':
                         # report g1 grammar
-                        # annotated_reply, grammar_match = self.get_chatbot_reply(self.received_text)
                         self.received_text = None
-                        self.parse_chatbot_reply(self.planned_reply)
+                        self.parse_chatbot_reply(self.planned_reply.result())
                         self.planned_reply = ''
                         self.detected_grammar = {'g1': '', 'g2': ''}
                         self.TalkML_currState = self.TKML_States.HEARD.value
+                    else:
+                        event = self.next_event()
+                        if self.timer_fired(event, 'no_match'):
+                            break
+                        self.timer_fired(event, 'heard')
+                self.cancel_timers()
+                if self.interrupted:
+                    return False
 
                 if self.TalkML_currState == self.TKML_States.HEARING.value:
                     # report g2 grammar or no match
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Microbenchmark of the compiled GrammarMatcher against the substring based check_grammar
+# bbc_demo used before. Utterances are the lines of talkml_bbc/script and every grammar
+# of each .gmr file is tested against each of them, as bbc_demo does for g1|g2.
+#
+# usage: python benchmarks/grammar_benchmark.py [repeats]
+
+import sys
+import time
+import glob
+from os.path import join, dirname, abspath, basename
+
+root_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, root_dir)
+from grammar_matcher import GrammarMatcher
+
+
+def legacy_load(grammar_file):
+    grammars = dict()
+    grammars_mult = dict()
+    with open(grammar_file) as f:
+        content = f.readlines()
+    content = [x.strip() for x in content]
+    for j in content:
+        parts = j.split('.*')
+        key = parts[0].replace('\t', '')
+        vals = parts[1][1:-1].split('|')
+        for v in vals:
+            if "*" in v:
+                try:
+                    grammars_mult[key].append(v.split("*"))
+                except:
+                    grammars_mult[key] = [v.split("*")]
+            else:
+                try:
+                    grammars[key].append(v)
+                except:
+                    grammars[key] = [v]
+    return grammars, grammars_mult
+
+
+def legacy_check_grammar(grammars, grammars_mult, grm, text):
+    text = text.lower()
+    b2 = False
+    b1 = False
+
+    if grm in grammars.keys():
+        b1 = any(wrd in text for wrd in grammars[grm])
+
+    if grm in grammars_mult.keys():
+        for k in grammars_mult[grm]:
+            b2 = b2 or all(wrd in text for wrd in k)
+
+    if b1 or b2:
+        return True
+    else:
+        return False
+
+
+def load_utterances():
+    utterances = []
+    with open(join(root_dir, "talkml_bbc", "script")) as f:
+        for line in f:
+            line = line.strip()
+            if line != '':
+                utterances.append(line.split(':')[-1].strip())
+    return utterances
+
+
+def run(grammar_file, utterances, repeats):
+    grammars, grammars_mult = legacy_load(grammar_file)
+    keys = list(set(grammars.keys() + grammars_mult.keys()))
+
+    t0 = time.time()
+    for r in range(repeats):
+        for u in utterances:
+            [g for g in keys if legacy_check_grammar(grammars, grammars_mult, g, u)]
+    t_legacy = time.time() - t0
+
+    t0 = time.time()
+    matcher = GrammarMatcher.from_file(grammar_file)
+    t_compile = time.time() - t0
+
+    t0 = time.time()
+    for r in range(repeats):
+        for u in utterances:
+            matcher.match(u)
+    t_compiled = time.time() - t0
+
+    num_calls = float(repeats * len(utterances))
+    print basename(grammar_file), "| grammars:", len(keys), "| compile:", round(t_compile * 1e3, 3), "ms"
+    print "    check_grammar  :", round(t_legacy / num_calls * 1e6, 2), "us/utterance"
+    print "    GrammarMatcher :", round(t_compiled / num_calls * 1e6, 2), "us/utterance", \
+        "| speedup x" + str(round(t_legacy / t_compiled, 1))
+
+
+if __name__ == '__main__':
+    repeats = 200
+    if len(sys.argv) > 1:
+        repeats = int(sys.argv[1])
+    utterances = load_utterances()
+    print "utterances:", len(utterances), "| repeats:", repeats
+    for gmr in sorted(glob.glob(join(root_dir, "talkml_bbc", "*.gmr"))):
+        run(gmr, utterances, repeats)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+# Offline end-to-end benchmark of the speech pipeline over a directory of recorded wav files
+# (16 kHz, 16 bit, mono). Each file goes through the same stages as on the robot, with queues
+# standing in for the YARP ports between modules:
+#
+#   tokenizer    NumpyVAD + pre-roll + auditok StreamTokenizer, utterances into an AudioRing
+#   asr          deepSpeechToText's worker pool reading the ring (classify_shared), results in
+#                arrival order. With --asr mock the transcript is read from <file>.txt instead
+#   dialog       GrammarMatcher, TalkML request and reply plan compilation as in bbc_demo
+#
+# TalkML requests go to a mock endpoint started in process unless --talkml-url is given.
+# Results are printed (or written with --output) as json: throughput in audio seconds per wall
+# second, per stage latency percentiles and peak RSS, so runs of different versions can be diffed.
+#
+# usage: python benchmarks/pipeline_benchmark.py wav_dir [--asr deepspeech|mock] [--output file]
+
+import os
+import sys
+import glob
+import json
+import time
+import wave
+import Queue
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+from collections import deque
+from os.path import join, dirname, abspath, basename, splitext, isfile
+
+root_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, root_dir)
+from auditok import ADSFactory, StreamTokenizer
+from numpy_vad import NumpyVAD
+from preroll_buffer import PrerollBuffer
+from audio_ring import AudioRing
+from grammar_matcher import GrammarMatcher
+from reply_plan import ReplyPlanCompiler
+from talkml_client import TalkMLClient
+from turn_trace import TurnTracer, new_turn_id
+
+# sentence_tokenizer defaults
+tok_window = 0.01
+tok_window_rate = 1. / tok_window
+tok_energy_threshold = 40
+tok_min_len = 0.5 * tok_window_rate
+tok_max_len = int(5 * tok_window_rate)
+tok_max_silence_duration = 0.7 * tok_window_rate
+vad_block_frames = 5
+vad_margin = 12
+preroll_duration = 0.3
+
+# bbc_demo gestures and emotions
+list_of_actions = ["left_arm_gun_pt1", "fast_long_wave", "left_arm_outstretched",
+                   "hand_up_5_fingers_palm_outward", "left_arm_kill", "left_arm_outstretched_you_got_it",
+                   "hand_up_5_fingers_palm_inward", "left_arm_outstretched_thumbs_up"]
+list_of_emotions = ["neutral", "talking", "happy", "sad", "surprised", "evil", "angry", "shy", "cunning"]
+
+mock_reply = "<say>That is interesting <gesture>fast_long_wave</gesture> tell me more " \
+             "<emotion>happy</emotion> about it.</say>"
+
+
+class LocalPort(object):
+    # In process stand-in for a BufferedPortBottle between two modules. None ends the stream.
+    # With maxsize, write blocks while maxsize messages are waiting
+    def __init__(self, maxsize=0):
+        self.queue = Queue.Queue(maxsize)
+
+    def write(self, *values):
+        self.queue.put(values)
+
+    def close(self):
+        self.queue.put(None)
+
+    def read(self, timeout=None):
+        # An empty tuple when nothing arrived within timeout
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return ()
+
+
+class MockTalkMLHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Every request expects any grammar of the .gmr file and gets the same reply
+    grammar_ids = []
+    latency = 0.0
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        time.sleep(self.latency)
+        if request.get('action') == 'upload':
+            reply = dict()
+        else:
+            reply = {'sayThis': mock_reply, 'g1': '|'.join(self.grammar_ids), 'g2': ''}
+        body = json.dumps(reply)
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_mock_talkml(grammar_ids, latency):
+    MockTalkMLHandler.grammar_ids = sorted(grammar_ids)
+    MockTalkMLHandler.latency = latency
+    server = ThreadedHTTPServer(('127.0.0.1', 0), MockTalkMLHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:" + str(server.server_address[1])
+
+
+def audio_duration(wav_file):
+    w = wave.open(wav_file)
+    duration = w.getnframes() / float(w.getframerate())
+    w.close()
+    return duration
+
+
+def read_transcript(wav_file):
+    txt_file = splitext(wav_file)[0] + ".txt"
+    if isfile(txt_file):
+        with open(txt_file) as f:
+            return f.read().strip()
+    return ''
+
+
+def tokenizer_stage(wav_files, ring, audio_port, tracer):
+    for wav_file in wav_files:
+        ads = ADSFactory.ads(filename=wav_file, record=False, block_dur=tok_window * vad_block_frames)
+        vad = NumpyVAD(ads, block_frames=vad_block_frames, energy_threshold=tok_energy_threshold,
+                       margin=vad_margin)
+        preroll_frames = int(preroll_duration * tok_window_rate)
+        preroll = PrerollBuffer(vad, preroll_frames,
+                                preroll_frames + tok_max_len + int(tok_max_silence_duration) + 10)
+        tokenizer = StreamTokenizer(validator=vad, min_length=tok_min_len, max_length=tok_max_len,
+                                    max_continuous_silence=tok_max_silence_duration,
+                                    mode=StreamTokenizer.DROP_TRAILING_SILENCE)
+        transcript = read_transcript(wav_file)
+        # Time spent tokenizing since the previous utterance was handed on, not waiting for the asr stage
+        last = [time.time()]
+
+        def tok_callback(data, start, end, starting=False):
+            if data is None:
+                return
+            turn_id = new_turn_id()
+            data = [preroll.get_preroll(start)] + data
+            offset, length, seq = ring.write(data)
+            tracer.record(turn_id, 'tokenize', last[0])
+            audio_port.write(turn_id, time.time(), offset, length, seq, ads.get_sampling_rate(), transcript)
+            last[0] = time.time()
+
+        ads.open()
+        tokenizer.tokenize(preroll, callback=tok_callback)
+        ads.close()
+    audio_port.close()
+
+
+def asr_stage(pool, classify_shared, ring_file, audio_port, text_port, tracer, max_pending=8):
+    # Submits in arrival order and writes results in the same order, as deepSpeechToText does.
+    # Offline the tokenizer runs faster than real time, so a full queue waits instead of dropping
+    pending = deque()
+    ended = False
+    while not ended or len(pending) > 0:
+        if not ended and len(pending) < max_pending:
+            message = audio_port.read(0.01 if len(pending) > 0 else None)
+            if message is None:
+                ended = True
+            elif len(message) > 0:
+                turn_id, t_token, offset, length, seq, rate, transcript = message
+                if pool is None:
+                    tracer.record(turn_id, 'asr', time.time())
+                    text_port.write(turn_id, t_token, transcript)
+                else:
+                    pending.append((turn_id, t_token, time.time(),
+                                    pool.apply_async(classify_shared, (ring_file, offset, length, seq, rate))))
+        else:
+            pending[0][3].wait(0.01)
+
+        while len(pending) > 0 and pending[0][3].ready():
+            turn_id, t_token, t0, result = pending.popleft()
+            text = result.get()
+            tracer.record(turn_id, 'asr', t0)
+            text_port.write(turn_id, t_token, text)
+    text_port.close()
+
+
+def dialog_stage(matcher, compiler, client, text_port, tracer, results):
+    expected = {'g1': '', 'g2': ''}
+    while True:
+        message = text_port.read()
+        if message is None:
+            break
+        turn_id, t_token, text = message
+        results['utterances'] += 1
+        if text is None:
+            # Audio overwritten in the ring before it was classified
+            results['asr_errors'] += 1
+            continue
+        if text == '':
+            results['empty'] += 1
+            continue
+
+        with tracer.span(turn_id, 'grammar'):
+            matched = matcher.match(text)
+        request = {'action': 'nomatch', 'version': '1.0'}
+        for g in (expected['g1'] or '').split('|') + (expected['g2'] or '').split('|'):
+            if g != '' and g in matched:
+                request = {'action': 'heard', 'grammar': g, 'version': '1.0'}
+                break
+
+        with tracer.span(turn_id, 'talkml'):
+            reply = client.send(request)
+        if reply is None or reply.status_code != 200:
+            results['talkml_errors'] += 1
+            continue
+        reply_json = reply.json()
+        expected = {'g1': reply_json.get('g1') or '', 'g2': reply_json.get('g2') or ''}
+
+        with tracer.span(turn_id, 'plan'):
+            compiler.compile(str(reply_json.get('sayThis')))
+        tracer.record(turn_id, 'turn', t_token)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root_dir,
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    wav_files = sorted(glob.glob(join(args.wav_dir, "*.wav")))
+    if len(wav_files) == 0:
+        print "No wav files in", args.wav_dir
+        sys.exit(1)
+    audio_seconds = sum([audio_duration(w) for w in wav_files])
+
+    matcher = GrammarMatcher.from_file(args.grammar)
+    compiler = ReplyPlanCompiler(list_of_actions, list_of_emotions)
+    server = None
+    talkml_url = args.talkml_url
+    if talkml_url is None:
+        server, talkml_url = start_mock_talkml(matcher.grammar_ids, args.talkml_latency)
+    client = TalkMLClient(talkml_url, {'Content-type': 'application/json', 'DId': 'proseco.benchmark',
+                                       'SId': 'proseco.'})
+    if args.talkml_url is not None:
+        with open(args.tkml) as f:
+            client.send({'version': '1.0', 'action': 'upload', 'tkml': f.read().replace("\n", " ")})
+        client.send({'action': 'start', 'version': '1.0'})
+
+    # Forked before any thread is started, as in deepSpeechToText
+    pool = None
+    classify_shared = None
+    if args.asr == 'deepspeech':
+        import deepSpeechToText
+        classify_shared = deepSpeechToText.classify_shared
+        ds = deepSpeechToText.deepSpeechToText()
+        pool = multiprocessing.Pool(args.workers, initializer=deepSpeechToText.init_worker,
+                                    initargs=(join(ds.ds_root_dir, "output_graph.pb"), ds.ds_N_FEATURES,
+                                              ds.ds_N_CONTEXT, join(ds.ds_root_dir, "alphabet.txt"),
+                                              ds.ds_BEAM_WIDTH, join(ds.ds_root_dir, "lm.binary"),
+                                              join(ds.ds_root_dir, "trie"), ds.ds_LM_WEIGHT,
+                                              ds.ds_WORD_COUNT_WEIGHT, ds.ds_VALID_WORD_COUNT_WEIGHT))
+        # Model loading is not part of the measurement
+        if not deepSpeechToText.warm_pool(pool, args.workers):
+            print "Error loading model in workers"
+            pool.terminate()
+            sys.exit(1)
+
+    ring_file = join(tempfile.gettempdir(), "pipeline_benchmark_audio")
+    ring = AudioRing(ring_file, create=True)
+    tracer = TurnTracer('pipeline_benchmark', history=1000000)
+    # The tokenizer runs ahead of the asr stage offline. Bounding the utterances in flight, at
+    # most 5 s each, keeps them well within the 16 MB ring so none is overwritten before it is read
+    audio_port = LocalPort(maxsize=8)
+    text_port = LocalPort()
+    results = {'utterances': 0, 'empty': 0, 'asr_errors': 0, 'talkml_errors': 0}
+
+    threads = [threading.Thread(target=asr_stage, args=(pool, classify_shared, ring_file, audio_port,
+                                                        text_port, tracer)),
+               threading.Thread(target=dialog_stage, args=(matcher, compiler, client, text_port, tracer,
+                                                           results))]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    tokenizer_stage(wav_files, ring, audio_port, tracer)
+    for t in threads:
+        t.join()
+    wall_seconds = time.time() - t0
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    client.close()
+    ring.close()
+    os.remove(ring_file)
+    if server is not None:
+        server.shutdown()
+
+    # ru_maxrss is in kB on Linux. Children covers the ASR workers once they have been joined
+    report = {'commit': git_commit(),
+              'asr': args.asr,
+              'files': len(wav_files),
+              'utterances': results['utterances'],
+              'empty_transcripts': results['empty'],
+              'asr_errors': results['asr_errors'],
+              'talkml_errors': results['talkml_errors'],
+              'audio_seconds': audio_seconds,
+              'wall_seconds': wall_seconds,
+              'throughput': audio_seconds / wall_seconds,
+              'stages': tracer.stats(),
+              'peak_rss_kb': {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                              'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline end-to-end pipeline benchmark")
+    parser.add_argument('wav_dir')
+    parser.add_argument('--asr', choices=['deepspeech', 'mock'], default='deepspeech')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--grammar', default=join(root_dir, "talkml_bbc", "TonyInterview_v3.gmr"))
+    parser.add_argument('--tkml', default=join(root_dir, "talkml_bbc", "TonyInterview_v3.tkml"))
+    parser.add_argument('--talkml-url', default=None, help="TalkML endpoint, a mock is started if not given")
+    parser.add_argument('--talkml-latency', type=float, default=0.0, help="latency of the mock endpoint in s")
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    # The modules report progress with print, keep stdout for the json report
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    report = json.dumps(run(args), indent=2, sort_keys=True)
+    sys.stdout = stdout
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    print report
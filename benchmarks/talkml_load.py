@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Load generator for a TalkML endpoint. Replays many simulated dialog sessions at once, each
+# with its own TalkMLClient and SId, and reports request throughput and per action latency
+# percentiles as json. Without --url a local talkml_server is started with --latency/--jitter.
+#
+# A session answers every say that expects input with one of its grammars, or with nomatch /
+# noinput at the given rates, and follows getSayNext until the script ends or --max-turns.
+#
+# usage: python benchmarks/talkml_load.py [--sessions 50] [--concurrency 10] [--url url]
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import Queue
+from os.path import join, dirname, abspath
+
+root_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, root_dir)
+from talkml_client import TalkMLClient
+from talkml_server import start_server
+from turn_trace import latency_stats
+
+
+class LoadStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = dict()
+        self.errors = 0
+        self.sessions_done = 0
+
+    def record(self, action, duration, ok):
+        self.lock.acquire()
+        self.durations.setdefault(action, []).append(duration)
+        self.durations.setdefault('all', []).append(duration)
+        if not ok:
+            self.errors += 1
+        self.lock.release()
+
+
+def send(client, stats, message):
+    t0 = time.time()
+    reply = client.send(message)
+    ok = reply is not None and reply.status_code == 200
+    stats.record(message['action'], time.time() - t0, ok)
+    if not ok:
+        return None
+    return reply.json()
+
+
+def run_session(url, d_id, s_id, tkml, args, stats, rng):
+    client = TalkMLClient(url, {'Content-type': 'application/json', 'DId': 'proseco.' + d_id,
+                                'SId': 'proseco.' + s_id})
+    try:
+        if tkml is not None:
+            send(client, stats, {'version': '1.0', 'action': 'upload', 'tkml': tkml})
+        reply = send(client, stats, {'action': 'start', 'version': '1.0'})
+        for turn in range(args.max_turns):
+            if reply is None:
+                break
+            g1 = reply.get('g1') or ''
+            if reply.get('sayThis', '') == '' and g1 == '':
+                break
+            if args.think_time > 0:
+                time.sleep(rng.uniform(0, args.think_time))
+            if g1 == '':
+                message = {'action': 'getSayNext', 'version': '1.0'}
+            else:
+                r = rng.random()
+                if r < args.noinput_rate:
+                    message = {'action': 'noinput', 'version': '1.0'}
+                elif r < args.noinput_rate + args.nomatch_rate:
+                    message = {'action': 'nomatch', 'version': '1.0'}
+                else:
+                    grammars = g1.split('|') + [g for g in (reply.get('g2') or '').split('|') if g != '']
+                    message = {'action': 'heard', 'grammar': rng.choice(grammars), 'version': '1.0'}
+            reply = send(client, stats, message)
+    finally:
+        client.close()
+    stats.lock.acquire()
+    stats.sessions_done += 1
+    stats.lock.release()
+
+
+def worker(url, tkml, args, stats, sessions):
+    rng = random.Random()
+    while True:
+        try:
+            s_id = sessions.get_nowait()
+        except Queue.Empty:
+            return
+        # With --upload every session uploads the script under its own DId, as separate robots would
+        d_id = 'load' + str(s_id) if args.upload else 'load'
+        run_session(url, d_id, str(s_id), tkml if args.upload else None, args, stats, rng)
+
+
+def run(args):
+    with open(args.tkml) as f:
+        tkml = f.read().replace("\n", " ")
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_server(latency=args.latency, jitter=args.jitter, tkml=tkml)
+
+    stats = LoadStats()
+    if args.url is not None and not args.upload:
+        # Sessions share one dialog, uploaded once
+        client = TalkMLClient(url, {'Content-type': 'application/json', 'DId': 'proseco.load', 'SId': 'proseco.'})
+        send(client, stats, {'version': '1.0', 'action': 'upload', 'tkml': tkml})
+        client.close()
+
+    sessions = Queue.Queue()
+    for s in range(args.sessions):
+        sessions.put(s)
+    threads = [threading.Thread(target=worker, args=(url, tkml, args, stats, sessions))
+               for _ in range(args.concurrency)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_seconds = time.time() - t0
+
+    if server is not None:
+        server.shutdown()
+
+    num_requests = len(stats.durations.get('all', []))
+    return {'url': args.url,
+            'sessions': stats.sessions_done,
+            'concurrency': args.concurrency,
+            'requests': num_requests,
+            'errors': stats.errors,
+            'wall_seconds': wall_seconds,
+            'requests_per_second': num_requests / wall_seconds,
+            'latency': latency_stats(stats.durations)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multi-session TalkML load generator")
+    parser.add_argument('--url', default=None, help="TalkML endpoint, a local stand-in is started if not given")
+    parser.add_argument('--tkml', default=join(root_dir, "talkml_bbc", "TonyInterview_v3.tkml"))
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--max-turns', type=int, default=50)
+    parser.add_argument('--nomatch-rate', type=float, default=0.1)
+    parser.add_argument('--noinput-rate', type=float, default=0.05)
+    parser.add_argument('--think-time', type=float, default=0.0, help="max random pause before each request in s")
+    parser.add_argument('--upload', action='store_true', help="every session uploads the tkml under its own DId")
+    parser.add_argument('--latency', type=float, default=0.05, help="latency of the local stand-in in s")
+    parser.add_argument('--jitter', type=float, default=0.02, help="jitter of the local stand-in in s")
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    # TalkMLClient reports every request with print, keep stdout for the json report
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    report = json.dumps(run(args), indent=2, sort_keys=True)
+    sys.stdout = stdout
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    print report
@@ -11,9 +11,117 @@ import yarp
 from deepspeech.model import Model
 import os
 from os.path import join
+from collections import deque
+import multiprocessing
+import threading
+import Queue
+from audio_ring import AudioRing
+from turn_trace import TurnTracer, find_turn_id
 warnings.simplefilter("ignore")
 np.set_printoptions(precision=2)
 
+# Model and shared audio rings held by each worker process of the classification pool
+worker_model = None
+worker_error = None
+worker_rings = dict()
+
+
+def init_worker(model_file, n_features, n_context, alphabet_file, beam_width, language_model, trie,
+                lm_weight, word_count_weight, valid_word_count_weight):
+    # A worker whose initializer raises is replaced by the pool forever, so the error is kept
+    # and raised by probe_worker instead
+    global worker_model, worker_error
+    try:
+        worker_model = Model(model_file, n_features, n_context, alphabet_file, beam_width)
+        worker_model.enableDecoderWithLM(alphabet_file, language_model, trie, lm_weight,
+                                         word_count_weight, valid_word_count_weight)
+    except Exception as e:
+        worker_error = repr(e)
+
+
+def probe_worker(rate):
+    # Decodes a short silence so the model is known to work, returns the worker's pid
+    if worker_error is not None:
+        raise RuntimeError("model failed to load: " + worker_error)
+    worker_model.stt(np.zeros(rate / 10, np.int16), rate)
+    return os.getpid()
+
+
+def warm_pool(pool, num_workers, rate=16000, attempts=10):
+    # Probes until every worker has answered once. False if a worker cannot decode
+    pids = set()
+    try:
+        for _ in range(attempts):
+            pids.update(pool.map(probe_worker, [rate] * num_workers, chunksize=1))
+            if len(pids) >= num_workers:
+                break
+    except Exception as e:
+        print e
+        return False
+    return True
+
+
+class DeepSpeechStream(object):
+    # Incremental decoding of one utterance. Uses the streaming API of deepspeech >= 0.2 when
+    # the model has it, otherwise audio is buffered and decoded in one go on finish.
+    def __init__(self, model, rate, partial_interval=0.3):
+        self.model = model
+        self.rate = rate
+        self.partial_samples = int(partial_interval * rate)
+        self.samples = 0
+        self.last_partial = 0
+        self.buffers = []
+        self.ctx = None
+        if hasattr(model, 'setupStream'):
+            self.ctx = model.setupStream(sample_rate=rate)
+
+    def feed(self, data):
+        if len(data) % 2 != 0:
+            data += '\x00'
+        audio = np.frombuffer(data, np.int16)
+        if self.ctx is not None:
+            self.model.feedAudioContent(self.ctx, audio)
+        else:
+            self.buffers.append(audio)
+        self.samples += len(audio)
+
+    def partial(self):
+        if self.ctx is not None and self.samples - self.last_partial >= self.partial_samples:
+            self.last_partial = self.samples
+            return self.model.intermediateDecode(self.ctx)
+        return None
+
+    def finish(self):
+        if self.ctx is not None:
+            return self.model.finishStream(self.ctx)
+        elif len(self.buffers) > 0:
+            return self.model.stt(np.concatenate(self.buffers), self.rate)
+        return ''
+
+
+def classify(data, rate):
+    if len(data) % 2 != 0:
+        data += '\x00'
+    converted_data = np.frombuffer(data, np.int16)
+    return worker_model.stt(converted_data, rate)
+
+
+def classify_shared(ring_file, offset, length, seq, rate):
+    # Audio is read in place from the shared ring written by sentence_tokenizer. None if it was
+    # overwritten before classification finished
+    if ring_file not in worker_rings.keys():
+        worker_rings[ring_file] = AudioRing(ring_file)
+    ring = worker_rings[ring_file]
+    converted_data = ring.read(offset, length, seq)
+    if converted_data is None:
+        print "Audio overwritten in ring before classification"
+        return None
+    this_sentence = worker_model.stt(converted_data, rate)
+    if not ring.is_intact(length, seq):
+        print "Audio overwritten in ring during classification"
+        return None
+    return this_sentence
+
 
 class deepSpeechToText(yarp.RFModule):
     def __init__(self):
@@ -28,7 +136,6 @@ class deepSpeechToText(yarp.RFModule):
         self.ds_trie = None
         self.ds_model = None
         self.tokenizer_ctrl_bottle = None
-        self.t = [0]*3
         self.ds_root_dir = os.environ['DEEPSPEECH_DIR']
 
         # self.sentence_list = []
@@ -42,11 +149,67 @@ class deepSpeechToText(yarp.RFModule):
         self.ds_N_FEATURES = 26
         self.ds_N_CONTEXT = 9
         self.busy = False
-        self.currPos = 0
-        self.list_of_classifications = []
         self.my_mutex = thread.allocate_lock()
 
+        # Classification pool, results are written out in the order requests arrived
+        self.num_workers = 2
+        self.max_pending = 8
+        self.pool = None
+        self.pending = deque()
+
+        # Streaming inference: stream_start/stream_feed/stream_finish per utterance id
+        self.streaming_enabled = False
+        self.streams = dict()
+        self.stream_times = dict()
+        self.stream_timeout = 10.0
+        self.stream_queue = Queue.Queue()
+        self.stream_thread = None
+        self.text_lock = threading.Lock()
+        self.tracer = None
+
     def configure(self, rf):
+        workers_val = rf.find('workers').toString_c()
+        if workers_val != '':
+            self.num_workers = int(workers_val)
+
+        streaming_val = rf.find('streaming').toString_c().lower()
+        if streaming_val != '':
+            self.streaming_enabled = streaming_val == 'true'
+
+        trace_val = rf.find('trace_file').toString_c()
+        self.tracer = TurnTracer('deepSpeechToText', trace_val if trace_val != '' else None)
+
+        # Setting up deep speech model client
+        self.ds_model_file = join(self.ds_root_dir, "output_graph.pb")
+        self.ds_alphabet_file = join(self.ds_root_dir, "alphabet.txt")
+        self.ds_language_model = join(self.ds_root_dir, "lm.binary")
+        self.ds_trie = join(self.ds_root_dir, "trie")
+
+        # Workers are forked before any port is opened
+        self.pool = multiprocessing.Pool(self.num_workers, initializer=init_worker,
+                                         initargs=(self.ds_model_file, self.ds_N_FEATURES, self.ds_N_CONTEXT,
+                                                   self.ds_alphabet_file, self.ds_BEAM_WIDTH,
+                                                   self.ds_language_model, self.ds_trie, self.ds_LM_WEIGHT,
+                                                   self.ds_WORD_COUNT_WEIGHT, self.ds_VALID_WORD_COUNT_WEIGHT))
+        if not warm_pool(self.pool, self.num_workers):
+            print "Error loading model in workers"
+            self.pool.terminate()
+            self.pool = None
+            return False
+        print "Model loaded in", self.num_workers, "workers and ready to start"
+
+        if self.streaming_enabled:
+            # Streams keep decoder state between chunks so they share one model in this process
+            self.ds_model = Model(self.ds_model_file, self.ds_N_FEATURES, self.ds_N_CONTEXT,
+                                  self.ds_alphabet_file, self.ds_BEAM_WIDTH)
+            self.ds_model.enableDecoderWithLM(self.ds_alphabet_file, self.ds_language_model, self.ds_trie,
+                                              self.ds_LM_WEIGHT, self.ds_WORD_COUNT_WEIGHT,
+                                              self.ds_VALID_WORD_COUNT_WEIGHT)
+            self.stream_thread = threading.Thread(target=self.stream_worker)
+            self.stream_thread.daemon = True
+            self.stream_thread.start()
+            print "Streaming model loaded"
+
         # Setting up rpc port
 
         self.portsList["rpc"] = yarp.Port()
@@ -57,33 +220,34 @@ class deepSpeechToText(yarp.RFModule):
         self.portsList["text_out"] = yarp.BufferedPortBottle()
         self.portsList["text_out"].open("/deepSpeechToText/text:o")
 
+        # Partials of streamed utterances go out separately, only listeners that want them connect
+        self.portsList["partial_out"] = yarp.BufferedPortBottle()
+        self.portsList["partial_out"].open("/deepSpeechToText/partial:o")
+
+        # Results of transcribe requests, as transcript <text> <request id>
+        self.portsList["transcript_out"] = yarp.BufferedPortBottle()
+        self.portsList["transcript_out"].open("/deepSpeechToText/transcript:o")
+
         self.portsList["tokenizer_rpc"] = yarp.BufferedPortBottle()
         self.portsList["tokenizer_rpc"].open("/deepSpeechToText/tokenizer/rpc:o")
         self.tokenizer_ctrl_bottle = self.portsList["tokenizer_rpc"].prepare()
         yarp.Network.connect(self.portsList["tokenizer_rpc"].getName(), "/sentence_tokenizer/rpc:i")
 
-        # Setting up deep speech model client
-        self.ds_model_file = join(self.ds_root_dir, "output_graph.pb")
-        self.ds_alphabet_file = join(self.ds_root_dir, "alphabet.txt")
-        self.ds_language_model = join(self.ds_root_dir, "lm.binary")
-        self.ds_trie = join(self.ds_root_dir, "trie")
-
-        self.ds_model = Model(self.ds_model_file, self.ds_N_FEATURES, self.ds_N_CONTEXT,
-                              self.ds_alphabet_file, self.ds_BEAM_WIDTH)
-
-        self.ds_model.enableDecoderWithLM(self.ds_alphabet_file,
-                                          self.ds_language_model,
-                                          self.ds_trie,
-                                          self.ds_LM_WEIGHT,
-                                          self.ds_WORD_COUNT_WEIGHT,
-                                          self.ds_VALID_WORD_COUNT_WEIGHT)
-        print "Model loaded and ready to start"
         return True
 
     def close(self):
         print('Exiting ...')
         time.sleep(2)
 
+        if self.pool is not None:
+            self.pool.terminate()
+
+        if self.stream_thread is not None:
+            self.stream_queue.put(None)
+
+        if self.tracer is not None:
+            self.tracer.close()
+
         for j in self.portsList.keys():
             self.close_port(self.portsList[j])
 
@@ -101,20 +265,61 @@ class deepSpeechToText(yarp.RFModule):
         if action == "heartbeat":
             reply.addString('ack')
         elif action == "classify":
-            if command.size() == 3:
+            if command.size() == 3 or command.size() == 4:
                 # get(0) -> classify
                 # get(1) -> data string
                 # get(2) -> sampling rate
-                try:
-                    self.t[0] = time.time()
-                    self.list_of_classifications.append([command.get(1).asString(),
-                                                         command.get(2).asInt()])
-                except Exception as e:
-                    print e
+                # get(3) -> turn id, optional
+                self.submit(classify, (command.get(1).asString(), command.get(2).asInt()), reply,
+                            find_turn_id(command))
+            else:
+                reply.addString('nack')
+        # -------------------------------------------------
+        elif action == "transcribe":
+            # Like classify, but the transcript goes to transcript:o under the request id, even if empty
+            if command.size() == 4:
+                # get(1) -> data string
+                # get(2) -> sampling rate
+                # get(3) -> request id
+                self.submit(classify, (command.get(1).asString(), command.get(2).asInt()), reply,
+                            request_id=command.get(3).asString())
+            else:
+                reply.addString('nack')
+        # -------------------------------------------------
+        elif action == "classify_shm":
+            if (command.size() == 8 or command.size() == 9) and command.get(6).asInt() == 2 and \
+               command.get(7).asInt() == 1:
+                # get(1) -> shared audio ring file
+                # get(2) -> offset, get(3) -> length in bytes, get(4) -> seq
+                # get(5) -> sampling rate, get(6) -> sample width, get(7) -> channels
+                # get(8) -> turn id, optional
+                self.submit(classify_shared, (command.get(1).asString(), command.get(2).asInt(),
+                                              command.get(3).asInt(), int(command.get(4).asString()),
+                                              command.get(5).asInt()), reply, find_turn_id(command))
+            else:
+                reply.addString('nack')
+                reply.addString('expected 16 bit mono audio')
+        # -------------------------------------------------
+        elif action == "stream_start" or action == "stream_feed" or action == "stream_finish":
+            # stream_start <id> <rate> | stream_feed <id> <data string> | stream_finish <id>
+            if not self.streaming_enabled:
+                reply.addString('nack')
+                reply.addString('streaming disabled')
+            elif command.size() >= 2:
+                if action == "stream_start" and command.size() == 3:
+                    payload = command.get(2).asInt()
+                elif action == "stream_feed" and command.size() == 3:
+                    payload = command.get(2).asString()
+                else:
+                    payload = None
+                self.stream_queue.put((action, command.get(1).asString(), payload, time.time()))
                 reply.addString('ack')
             else:
                 reply.addString('nack')
         # -------------------------------------------------
+        elif action == "trace_stats":
+            self.tracer.add_stats(reply)
+        # -------------------------------------------------
         elif action == "EXIT":
             reply.addString('ack')
             self.close()
@@ -124,6 +329,73 @@ class deepSpeechToText(yarp.RFModule):
             reply.addString("Command not recognized")
         return True
 
+    def submit(self, func, args, reply, turn_id=None, request_id=None):
+        if len(self.pending) >= self.max_pending:
+            print "Classification queue full. Dropping request"
+            reply.addString('nack')
+            reply.addString('busy')
+            return
+        try:
+            self.my_mutex.acquire()
+            self.pending.append([time.time(), self.pool.apply_async(func, args), turn_id, request_id])
+        except Exception as e:
+            print e
+        finally:
+            self.my_mutex.release()
+        reply.addString('ack')
+
+    def write_text(self, keyword, text, turn_id=None, port="text_out"):
+        self.text_lock.acquire()
+        sentence_bottle = self.portsList[port].prepare()
+        sentence_bottle.clear()
+        sentence_bottle.addString(keyword)
+        sentence_bottle.addString(text)
+        if turn_id is not None:
+            sentence_bottle.addString(turn_id)
+        self.portsList[port].write()
+        self.text_lock.release()
+
+    def expire_streams(self):
+        # Streams whose stream_finish never arrived are dropped after stream_timeout
+        now = time.time()
+        for utterance_id in [k for k in self.stream_times.keys() if now - self.stream_times[k] > self.stream_timeout]:
+            print "Stream", utterance_id, "idle for", self.stream_timeout, "s. Dropping it"
+            self.streams.pop(utterance_id, None)
+            del self.stream_times[utterance_id]
+
+    def stream_worker(self):
+        while True:
+            try:
+                item = self.stream_queue.get(timeout=self.stream_timeout)
+            except Queue.Empty:
+                self.expire_streams()
+                continue
+            if item is None:
+                break
+            action, utterance_id, payload, t0 = item
+            self.expire_streams()
+            try:
+                if action == "stream_start":
+                    self.streams[utterance_id] = DeepSpeechStream(self.ds_model, payload)
+                    self.stream_times[utterance_id] = time.time()
+                elif action == "stream_feed" and utterance_id in self.streams.keys():
+                    self.stream_times[utterance_id] = time.time()
+                    self.streams[utterance_id].feed(payload)
+                    partial_sentence = self.streams[utterance_id].partial()
+                    if partial_sentence:
+                        self.write_text("partial", partial_sentence, port="partial_out")
+                elif action == "stream_finish" and utterance_id in self.streams.keys():
+                    self.stream_times.pop(utterance_id, None)
+                    this_sentence = self.streams.pop(utterance_id).finish()
+                    print "Time after end of audio = ", time.time() - t0
+                    print "Returned sentence: " + this_sentence
+                    if len(this_sentence) != 0:
+                        self.write_text("spoken", this_sentence)
+            except Exception as e:
+                print e
+                self.streams.pop(utterance_id, None)
+                self.stream_times.pop(utterance_id, None)
+
     def interruptModule(self):
         print "Interrupting"
         self.close()
@@ -133,36 +405,28 @@ class deepSpeechToText(yarp.RFModule):
         return 0.1
 
     def updateModule(self):
-        if self.currPos < len(self.list_of_classifications):
-            curr_recording = self.list_of_classifications[self.currPos]
+        if len(self.pending) == 0 or not self.pending[0][1].ready():
+            time.sleep(0.05)
+            return True
+
+        # Write out every finished result at the head of the queue to keep arrival order
+        while len(self.pending) > 0 and self.pending[0][1].ready():
+            self.my_mutex.acquire()
+            t0, result, turn_id, request_id = self.pending.popleft()
+            self.my_mutex.release()
             try:
-                if len(curr_recording[0]) % 2 != 0:
-                    curr_recording[0] += '\x00'
-                self.t[1] = time.time()
-                converted_data = np.fromstring(curr_recording[0], np.int16)
-                this_sentence = self.ds_model.stt(converted_data, curr_recording[1])
-                self.t[2] = time.time()
-                print "Time taken = ", self.t[2]-self.t[0]
-                print "Returned sentence: " + this_sentence
-                if len(this_sentence) != 0:
-                    sentence_bottle = self.portsList["text_out"].prepare()
-                    sentence_bottle.clear()
-                    sentence_bottle.addString("spoken")
-                    sentence_bottle.addString(this_sentence)
-                    self.portsList["text_out"].write()
+                this_sentence = result.get()
             except Exception as e:
                 print e
-                pass
-            self.currPos += 1
-        else:
-            # if len(self.list_of_classifications) != 0:
-            #     self.my_mutex.acquire()
-            #     print "update module mutex acquired"
-            #     self.currPos = 0
-            #     self.list_of_classifications = []
-            #     self.my_mutex.release()
-            #     print "update module mutex released"
-            time.sleep(0.05)
+                this_sentence = None
+            if request_id is not None:
+                self.write_text("transcript", this_sentence or '', request_id, port="transcript_out")
+            elif this_sentence is not None:
+                self.tracer.record(turn_id, 'asr', t0)
+                print "Time taken = ", time.time() - t0
+                print "Returned sentence: " + this_sentence
+                if len(this_sentence) != 0:
+                    self.write_text("spoken", this_sentence, turn_id)
         return True
 
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import re
+
+
+class GrammarMatcher(object):
+    # Compiles the grammars of a .gmr file into a single trie over words so that one pass
+    # over an utterance returns every grammar id it matches.
+    #
+    # .gmr lines look like:    key<TAB>.*(alt1|alt2|word1 * word2).*
+    # An alternative matches when it appears in the utterance on word boundaries. Parts of an
+    # alternative separated by '*' must all appear, in any order. An empty pattern (.*) matches
+    # everything.
+    END = None
+    word_re = re.compile(r"[a-z0-9']+")
+
+    def __init__(self):
+        self.trie = dict()
+        self.terms = []
+        self.alternatives = []
+        self.term_alternatives = []
+        self.match_all = set()
+        self.grammar_ids = set()
+
+    @classmethod
+    def from_file(cls, grammar_file):
+        matcher = cls()
+        with open(grammar_file) as f:
+            for line in f:
+                if line.strip() != '':
+                    matcher.add_line(line)
+        return matcher
+
+    def tokenize(self, text):
+        return self.word_re.findall(text.lower())
+
+    def add_line(self, line):
+        parts = line.strip().split(None, 1)
+        key = parts[0]
+        pattern = parts[1] if len(parts) > 1 else ''
+        pattern = pattern.replace('(', '').replace(')', '')
+        alternatives = [v.split('*') for v in pattern.replace('.*', '').split('|')]
+        self.add_grammar(key, alternatives)
+
+    def add_grammar(self, key, alternatives):
+        self.grammar_ids.add(key)
+        for alt in alternatives:
+            term_ids = set()
+            for phrase in alt:
+                words = self.tokenize(phrase)
+                if len(words) > 0:
+                    term_ids.add(self.add_term(words))
+            if len(term_ids) == 0:
+                self.match_all.add(key)
+            else:
+                alt_id = len(self.alternatives)
+                self.alternatives.append([key, len(term_ids)])
+                for t in term_ids:
+                    self.term_alternatives[t].append(alt_id)
+
+    def add_term(self, words):
+        node = self.trie
+        for w in words:
+            if w not in node:
+                node[w] = dict()
+            node = node[w]
+        if self.END not in node:
+            node[self.END] = len(self.terms)
+            self.terms.append(' '.join(words))
+            self.term_alternatives.append([])
+        return node[self.END]
+
+    def find_terms(self, words):
+        found = set()
+        num_words = len(words)
+        for i in range(num_words):
+            node = self.trie
+            j = i
+            while j < num_words and words[j] in node:
+                node = node[words[j]]
+                if self.END in node:
+                    found.add(node[self.END])
+                j += 1
+        return found
+
+    def match(self, text):
+        matched = set(self.match_all)
+        hits = dict()
+        for t in self.find_terms(self.tokenize(text)):
+            for alt_id in self.term_alternatives[t]:
+                hits[alt_id] = hits.get(alt_id, 0) + 1
+                if hits[alt_id] == self.alternatives[alt_id][1]:
+                    matched.add(self.alternatives[alt_id][0])
+        return matched
+
+    def check(self, grm, text):
+        return grm in self.match(text)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+import time
+import uuid
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from turn_trace import percentile
+
+
+class GoogleCloudBackend(object):
+    name = 'google'
+    default_confidence = 0.8
+
+    def __init__(self, credentials, phrases=None, language="en-UK"):
+        import speech_recognition as sr
+        self.asr = sr.Recognizer()
+        self.credentials = credentials
+        self.phrases = phrases
+        self.language = language
+
+    def recognize(self, bdata, rate, width):
+        import speech_recognition as sr
+        audio = sr.AudioData(bdata, rate, width)
+        try:
+            response = self.asr.recognize_google_cloud(audio_data=audio, credentials_json=self.credentials,
+                                                       language=self.language, preferred_phrases=self.phrases,
+                                                       show_all=True)
+        except sr.UnknownValueError:
+            return None, None
+        if not response or 'results' not in response:
+            return None, None
+        transcript = ' '.join([r['alternatives'][0]['transcript'].strip() for r in response['results']])
+        confidences = [r['alternatives'][0].get('confidence') for r in response['results']]
+        confidences = [c for c in confidences if c is not None]
+        if len(confidences) == 0:
+            return transcript, None
+        return transcript, min(confidences)
+
+
+class DeepSpeechBackend(object):
+    # 'transcribe' request to the deepSpeechToText module. The request is only queued there, the
+    # transcript comes back on its transcript:o port under the request id
+    name = 'deepspeech'
+    default_confidence = 0.6
+
+    def __init__(self, port_name="/sentence_tokenizer/deepspeech", remote="/deepSpeechToText", timeout=10.0):
+        import yarp
+        self.timeout = timeout
+        self.port = yarp.RpcClient()
+        self.port.open(port_name + "/rpc:o")
+        yarp.Network.connect(port_name + "/rpc:o", remote + ":rpc:i")
+        self.transcript_port = yarp.BufferedPortBottle()
+        self.transcript_port.open(port_name + "/transcript:i")
+        yarp.Network.connect(remote + "/transcript:o", port_name + "/transcript:i")
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        # request id -> [Event, transcript]
+        self.requests = dict()
+        self.reader = threading.Thread(target=self.read_transcripts)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_transcripts(self):
+        while True:
+            bottle = self.transcript_port.read()
+            if bottle is None:
+                break
+            if bottle.size() == 3 and bottle.get(0).asString() == "transcript":
+                self.lock.acquire()
+                request = self.requests.get(bottle.get(2).asString())
+                if request is not None:
+                    request[1] = bottle.get(1).asString()
+                    request[0].set()
+                self.lock.release()
+
+    def recognize(self, bdata, rate, width):
+        import yarp
+        request_id = uuid.uuid4().hex
+        request = [threading.Event(), None]
+        cmd = yarp.Bottle()
+        cmd.addString("transcribe")
+        cmd.addString(bdata)
+        cmd.addInt(rate)
+        cmd.addString(request_id)
+        rep = yarp.Bottle()
+        self.lock.acquire()
+        self.requests[request_id] = request
+        self.lock.release()
+        try:
+            self.write_lock.acquire()
+            try:
+                self.port.write(cmd, rep)
+            finally:
+                self.write_lock.release()
+            if rep.size() == 0 or rep.get(0).asString() != "ack":
+                return None, None
+            if not request[0].wait(self.timeout):
+                raise RuntimeError("no transcript from deepSpeechToText within " + str(self.timeout) + " s")
+        finally:
+            self.lock.acquire()
+            del self.requests[request_id]
+            self.lock.release()
+        if request[1] == '':
+            return None, None
+        return request[1], None
+
+    def close(self):
+        self.port.interrupt()
+        self.port.close()
+        self.transcript_port.interrupt()
+        self.transcript_port.close()
+
+
+class MockBackend(object):
+    # Local stand-in returning a fixed transcript after a fixed latency, for testing
+    default_confidence = 1.0
+
+    def __init__(self, name='mock', transcript='hello i cub', latency=0.2, confidence=None, fail=False):
+        self.name = name
+        self.transcript = transcript
+        self.latency = latency
+        self.confidence = confidence
+        self.fail = fail
+
+    def recognize(self, bdata, rate, width):
+        time.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError(self.name + " failed")
+        return self.transcript, self.confidence
+
+
+class HedgedRecognizer(object):
+    # Sends each utterance to every healthy backend at once. The first result with confidence of
+    # at least min_confidence wins, otherwise the most confident result received before the
+    # deadline is returned. A backend failing max_failures times in a row is skipped for
+    # cooldown seconds. Latency of every backend is recorded, including results that arrive
+    # after the winner.
+    def __init__(self, backends, deadline=3.0, min_confidence=0.7, max_failures=3, cooldown=30.0,
+                 history=200):
+        self.backends = backends
+        self.deadline = deadline
+        self.min_confidence = min_confidence
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.executor = ThreadPoolExecutor(max_workers=4 * max(len(backends), 1))
+        self.lock = threading.Lock()
+        self.latencies = dict()
+        self.wins = dict()
+        self.failures = dict()
+        self.consecutive_failures = dict()
+        self.disabled_until = dict()
+        for b in backends:
+            self.latencies[b.name] = deque(maxlen=history)
+            self.wins[b.name] = 0
+            self.failures[b.name] = 0
+            self.consecutive_failures[b.name] = 0
+            self.disabled_until[b.name] = 0
+
+    def healthy_backends(self):
+        now = time.time()
+        healthy = [b for b in self.backends if self.disabled_until[b.name] <= now]
+        if len(healthy) == 0:
+            return self.backends
+        return healthy
+
+    def run_backend(self, backend, bdata, rate, width):
+        t0 = time.time()
+        try:
+            text, confidence = backend.recognize(bdata, rate, width)
+        except Exception as e:
+            print "ASR backend", backend.name, "failed:", e
+            self.record(backend, time.time() - t0, False)
+            return backend, None, None
+        self.record(backend, time.time() - t0, True)
+        if confidence is None:
+            confidence = backend.default_confidence
+        return backend, text, confidence
+
+    def record(self, backend, latency, ok):
+        self.lock.acquire()
+        self.latencies[backend.name].append(latency)
+        if ok:
+            self.consecutive_failures[backend.name] = 0
+        else:
+            self.failures[backend.name] += 1
+            self.consecutive_failures[backend.name] += 1
+            if self.consecutive_failures[backend.name] >= self.max_failures:
+                print "ASR backend", backend.name, "disabled for", self.cooldown, "s"
+                self.disabled_until[backend.name] = time.time() + self.cooldown
+                self.consecutive_failures[backend.name] = 0
+        self.lock.release()
+
+    def recognize(self, bdata, rate, width):
+        pending = set([self.executor.submit(self.run_backend, b, bdata, rate, width)
+                       for b in self.healthy_backends()])
+        end_time = time.time() + self.deadline
+        best = None
+        while len(pending) > 0:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for f in done:
+                backend, text, confidence = f.result()
+                if text is None or text == '':
+                    continue
+                if best is None or confidence > best[2]:
+                    best = (backend, text, confidence)
+            if best is not None and best[2] >= self.min_confidence:
+                break
+        if best is None:
+            return None
+        self.lock.acquire()
+        self.wins[best[0].name] += 1
+        self.lock.release()
+        print "ASR winner", best[0].name, "confidence", best[2]
+        return best[1]
+
+    def stats(self):
+        # name -> count, wins, failures, p50, p95, p99 latency in seconds
+        self.lock.acquire()
+        result = dict()
+        for name in self.latencies.keys():
+            values = list(self.latencies[name])
+            result[name] = {'count': len(values), 'wins': self.wins[name], 'failures': self.failures[name],
+                            'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                            'p99': percentile(values, 99)}
+        self.lock.release()
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for b in self.backends:
+            if hasattr(b, 'close'):
+                b.close()
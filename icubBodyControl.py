@@ -9,10 +9,11 @@ import yarp
 import os
 from os.path import join
 import subprocess
-import copy
 import signal
+import threading
+import Queue
 from xml.etree import ElementTree as ET
-from operator import add
+from turn_trace import TurnTracer, find_turn_id
 warnings.simplefilter("ignore")
 np.set_printoptions(precision=2)
 
@@ -25,6 +26,13 @@ class ICubBodyControl(yarp.RFModule):
         self.controlPorts = dict()
         self.monitorPorts = dict()
         self.controlBottles = dict()
+        self.dispatchQueues = dict()
+        self.dispatchThreads = dict()
+        self.stateThreads = dict()
+        self.joint_state = dict()
+        self.state_updates = dict()
+        self.state_max_age = 0.5
+        self.state_timeout = 1.0
         self.rpcPort = None
         self.rpcPort = None
         self.windowed = True
@@ -34,16 +42,22 @@ class ICubBodyControl(yarp.RFModule):
         self.gestures_dict = dict()
         self.all_gestures_list = []
         self.all_gestures_files_list = []
+        self.gesture_info = dict()
+        self.ctp_cache = dict()
         self.ctp_processes = []
+        self.tracer = None
 
         self.parts = ['head', 'left_arm', 'right_arm', 'torso']
         self.parts_processes = []
         self.root_gesture_dir = "/home/icub/user_files/icub_gestures"
+        self.gesture_cache_file = join(self.root_gesture_dir, "compiled_gestures.npz")
 
     def configure(self, rf):
         persistence_val = rf.find('persistence').toString_c().lower()
         windowed_val = rf.find('windowed').toString_c().lower()
         robot_name_val = rf.find('robot').toString_c()
+        trace_val = rf.find('trace_file').toString_c()
+        self.tracer = TurnTracer('icubBodyControl', trace_val if trace_val != '' else None)
 
         if persistence_val != '':
             self.persistence = persistence_val == 'true'
@@ -82,6 +96,18 @@ class ICubBodyControl(yarp.RFModule):
                 time.sleep(0.5)
                 yarp.Network.connect(portName_control,  join("/ctpservice", part, "rpc"))
                 yarp.Network.connect("/" + join(self.robot_name, part, "state:o"), portName_monitor, "udp")
+
+                # Latest joint state of each part is kept by a background reader
+                self.state_updates[part] = threading.Condition()
+                self.stateThreads[part] = threading.Thread(target=self.state_reader, args=(part,))
+                self.stateThreads[part].daemon = True
+                self.stateThreads[part].start()
+
+                # Each part has its own dispatcher so parts are sent to ctpService in parallel
+                self.dispatchQueues[part] = Queue.Queue()
+                self.dispatchThreads[part] = threading.Thread(target=self.dispatch_worker, args=(part,))
+                self.dispatchThreads[part].daemon = True
+                self.dispatchThreads[part].start()
             else:
                 print "Error setting up ctpServices"
                 return False
@@ -102,11 +128,18 @@ class ICubBodyControl(yarp.RFModule):
 
     def close(self):
         print('Exiting ...')
+        self.interrupted = True
         time.sleep(2)
 
         for j in self.portsList.keys():
             self.close_port(self.portsList[j])
 
+        for j in self.monitorPorts.keys():
+            self.close_port(self.monitorPorts[j])
+
+        for j in self.dispatchQueues.keys():
+            self.dispatchQueues[j].put(None)
+
         for j in self.controlPorts.keys():
             self.close_port(self.controlPorts[j])
 
@@ -114,6 +147,9 @@ class ICubBodyControl(yarp.RFModule):
             p.send_signal(signal.SIGINT)
             p.wait()
 
+        if self.tracer is not None:
+            self.tracer.close()
+
         return True
 
     def start_process(self, cmd):
@@ -138,32 +174,90 @@ class ICubBodyControl(yarp.RFModule):
             if key_add not in dict_add.keys():
                 dict_add[key_add] = type_add
 
-    def send_ctp_messages(self, msg_list):
-        # Send all ctp commands to ctpService queue
+    def send_ctp_messages(self, bottle_list):
+        # Send all ctp commands to ctpService queue. Every part's dispatcher is released by the
+        # same event so all parts start together, and this returns once the slowest part is sent
+        start_event = threading.Event()
+        done_events = []
+        for part in bottle_list:
+            done_event = threading.Event()
+            done_events.append(done_event)
+            self.dispatchQueues[part].put((bottle_list[part], start_event, done_event))
+        start_event.set()
+        for done_event in done_events:
+            done_event.wait()
+
+    def dispatch_worker(self, part):
         rep_bot = yarp.Bottle()
-        for part in msg_list:
-            curr_bot = self.controlBottles[part]
-            for ts in msg_list[part]:
-                curr_bot.clear()
-                curr_bot.fromString(ts[1])
-                self.controlPorts[part].write(curr_bot, rep_bot)
+        while True:
+            job = self.dispatchQueues[part].get()
+            if job is None:
+                break
+            bottles, start_event, done_event = job
+            start_event.wait()
+            try:
+                for curr_bot in bottles:
+                    self.controlPorts[part].write(curr_bot, rep_bot)
+            except Exception as e:
+                print "Dispatch to", part, "failed:", e
+            done_event.set()
 
     @staticmethod
     def construct_ctp_message(duration, positions, offset=None):
-        msg = []
-        time_total = 0
-        for n in range(len(duration)):
-            time_total += duration[n]
-            if offset is not None:
-                offset_pos = map(add, positions[n], offset)
-            else:
-                offset_pos = positions[n]
-            m = ['[ctpq] [time]', str(duration[n]), '[off] 0 [pos]', str(tuple(offset_pos))]
-            msg.append([time_total, ' '.join(m)])
-        return msg
+        duration = np.asarray(duration, dtype=float)
+        positions = np.asarray(positions, dtype=float)
+        if offset is not None:
+            positions = positions + np.asarray(offset, dtype=float)
+        times = np.cumsum(duration).tolist()
+        duration = duration.tolist()
+        positions = positions.tolist()
+        return [[times[n], ' '.join(['[ctpq] [time]', str(duration[n]), '[off] 0 [pos]', str(tuple(positions[n]))])]
+                for n in range(len(duration))]
+
+    @staticmethod
+    def to_bottles(msg):
+        bottles = []
+        for ts in msg:
+            curr_bot = yarp.Bottle()
+            curr_bot.fromString(ts[1])
+            bottles.append(curr_bot)
+        return bottles
+
+    @staticmethod
+    def freeze_arrays(entry):
+        # Stored trajectories are read only so no move can alter the gesture library
+        for key in ['durations', 'positions', 'velocities']:
+            entry[key] = np.array(entry[key], dtype=float)
+            entry[key].flags.writeable = False
 
     def load_gestures(self):
-        self.all_gestures_files_list = [x for x in os.listdir(self.root_gesture_dir) if 'pos' in x]
+        self.all_gestures_files_list = sorted([x for x in os.listdir(self.root_gesture_dir) if 'pos' in x])
+        sources = self.get_gesture_sources()
+        if not self.load_gesture_cache(sources):
+            self.parse_gesture_files()
+            self.save_gesture_cache(sources)
+
+        # Gesture metadata served by getDuration, getDurations and listGestures
+        self.gesture_info = dict()
+        self.ctp_cache = dict()
+        for g in self.all_gestures_list:
+            self.gesture_info[g] = dict()
+            self.gesture_info[g]['parts'] = sorted([x for x in self.gestures_dict[g].keys() if x in self.parts])
+            self.gesture_info[g]['duration'] = max([float(np.sum(self.gestures_dict[g][p]['durations']))
+                                                    for p in self.gesture_info[g]['parts']] + [0])
+            # Parts whose positions are all zero are played relative to the current position
+            self.gesture_info[g]['relative'] = [p for p in self.gesture_info[g]['parts']
+                                                if p == 'head' or not np.any(self.gestures_dict[g][p]['positions'])]
+
+    def get_gesture_sources(self):
+        # Name, mtime and size of every gesture file. The compiled cache is rebuilt when any differ
+        sources = []
+        for j in self.all_gestures_files_list:
+            st = os.stat(join(self.root_gesture_dir, j))
+            sources.append(j + '\t' + repr(st.st_mtime) + '\t' + str(st.st_size))
+        return sources
+
+    def parse_gesture_files(self):
         self.all_gestures_list = []
         for j in self.all_gestures_files_list:
             try:
@@ -176,7 +270,7 @@ class ICubBodyControl(yarp.RFModule):
                 self.gestures_dict[curr_g_name][curr_part]['durations'] = []
                 self.gestures_dict[curr_g_name][curr_part]['positions'] = []
                 self.gestures_dict[curr_g_name][curr_part]['velocities'] = []
-                self.gestures_dict[curr_g_name]['total_duration'] = 0
+                self.check_add(self.gestures_dict[curr_g_name], 'total_duration', 0)
                 for k in range(int(curr_num_pos)):
                     self.gestures_dict[curr_g_name][curr_part]['durations'].append(
                         float(curr_xml[k].attrib['Timing']))
@@ -194,6 +288,79 @@ class ICubBodyControl(yarp.RFModule):
             except:
                 print "Invalid xml", j, "skipped"
         self.all_gestures_list = list(set(self.all_gestures_list))
+        for g in self.all_gestures_list:
+            for p in [x for x in self.gestures_dict[g].keys() if x != 'total_duration']:
+                self.freeze_arrays(self.gestures_dict[g][p])
+
+    def save_gesture_cache(self, sources):
+        # Every (gesture, part) is one entry of the index, its waypoints are rows start:end of the
+        # concatenated arrays. Joint vectors are padded with NaN to the widest part
+        names = []
+        bounds = []
+        num_joints = []
+        durations = []
+        positions = []
+        velocities = []
+        for g in sorted(self.all_gestures_list):
+            for p in sorted([x for x in self.gestures_dict[g].keys() if x != 'total_duration']):
+                entry = self.gestures_dict[g][p]
+                names.append(g + '\t' + p)
+                bounds.append([len(durations), len(durations) + len(entry['durations'])])
+                num_joints.append(max([len(x) for x in entry['positions']] + [0]))
+                durations.extend(entry['durations'])
+                positions.extend(entry['positions'])
+                velocities.extend(entry['velocities'])
+
+        width = max(num_joints + [0])
+        pos_array = np.full((len(durations), width), np.nan)
+        vel_array = np.full((len(durations), width), np.nan)
+        for r in range(len(durations)):
+            pos_array[r, :len(positions[r])] = positions[r]
+            vel_array[r, :len(velocities[r])] = velocities[r]
+
+        try:
+            np.savez(self.gesture_cache_file, sources=np.array(sources), names=np.array(names),
+                     bounds=np.array(bounds, dtype=np.int64).reshape(-1, 2),
+                     num_joints=np.array(num_joints, dtype=np.int64),
+                     durations=np.array(durations), positions=pos_array, velocities=vel_array)
+            print "Saved compiled gestures to", self.gesture_cache_file
+        except Exception as e:
+            print "Could not save compiled gestures:", e
+
+    def load_gesture_cache(self, sources):
+        if not os.path.isfile(self.gesture_cache_file):
+            return False
+        cache = None
+        try:
+            cache = np.load(self.gesture_cache_file)
+            if list(cache['sources']) != sources:
+                print "Gesture files changed. Recompiling"
+                return False
+            gestures_dict = dict()
+            durations = cache['durations']
+            positions = cache['positions']
+            velocities = cache['velocities']
+            for name, (start, end), n in zip(cache['names'], cache['bounds'], cache['num_joints']):
+                g, p = str(name).split('\t')
+                self.check_add(gestures_dict, g, dict())
+                gestures_dict[g][p] = dict()
+                gestures_dict[g][p]['durations'] = durations[start:end]
+                gestures_dict[g][p]['positions'] = positions[start:end, :n]
+                gestures_dict[g][p]['velocities'] = velocities[start:end, :n]
+                self.freeze_arrays(gestures_dict[g][p])
+                gestures_dict[g]['total_duration'] = max(gestures_dict[g].get('total_duration', 0),
+                                                         sum(gestures_dict[g][p]['durations']))
+        except Exception as e:
+            print "Invalid compiled gestures", self.gesture_cache_file, e
+            return False
+        finally:
+            # Arrays are already read, the file must be closed before a recompile overwrites it
+            if cache is not None:
+                cache.close()
+        self.gestures_dict = gestures_dict
+        self.all_gestures_list = gestures_dict.keys()
+        print "Loaded", len(self.all_gestures_list), "compiled gestures from", self.gesture_cache_file
+        return True
 
     @staticmethod
     def close_port(j):
@@ -211,6 +378,38 @@ class ICubBodyControl(yarp.RFModule):
             reply.addString('ack')
             self.close()
         # -------------------------------------------------
+        elif action == "getState":
+            # getState [part] -> ack (part age (joints)) ...
+            if command.size() >= 2:
+                state_parts = [command.get(1).asString()]
+            else:
+                state_parts = self.parts
+            reply.addString("ack")
+            for p in state_parts:
+                age, joints = self.get_state(p)
+                if age is not None:
+                    state_bottle = reply.addList()
+                    state_bottle.addString(p)
+                    state_bottle.addDouble(age)
+                    joints_bottle = state_bottle.addList()
+                    for v in joints:
+                        joints_bottle.addDouble(float(v))
+        # -------------------------------------------------
+        elif action == "trace_stats":
+            self.tracer.add_stats(reply)
+        # -------------------------------------------------
+        elif action == "getDurations" or action == "listGestures":
+            # One reply with every gesture: (name duration) or (name (parts) duration)
+            reply.addString("ack")
+            for g in sorted(self.all_gestures_list):
+                gesture_bottle = reply.addList()
+                gesture_bottle.addString(g)
+                if action == "listGestures":
+                    parts_bottle = gesture_bottle.addList()
+                    for p in self.gesture_info[g]['parts']:
+                        parts_bottle.addString(p)
+                gesture_bottle.addDouble(self.gesture_info[g]['duration'])
+        # -------------------------------------------------
         elif action == "move" or action == "getDuration":
             if command.size() >= 2:
                 # get(0) -> move
@@ -218,10 +417,14 @@ class ICubBodyControl(yarp.RFModule):
                 action_name = command.get(1).asString()
                 if action_name in self.all_gestures_list:
                     print command.toString()
-                    ret = self.do_action(action_name, args=command)
-                    reply.addString("ack")
                     if action == "getDuration":
-                        reply.addDouble(ret)
+                        _, init_duration = self.parse_move_args(command)
+                        reply.addString("ack")
+                        reply.addDouble(self.get_duration(action_name, init_duration))
+                    else:
+                        with self.tracer.span(find_turn_id(command), 'gesture_dispatch'):
+                            self.do_action(action_name, args=command)
+                        reply.addString("ack")
                 else:
                     reply.addString("nack")
                     reply.addString("gesture name " + action_name + "not found.")
@@ -235,10 +438,9 @@ class ICubBodyControl(yarp.RFModule):
             reply.addString("Command not recognized")
         return True
 
-    def do_action(self, action_name, args=None):
-        msg_list = dict()
+    @staticmethod
+    def parse_move_args(args):
         args_list = []
-        curr_action = self.gestures_dict[action_name]
         init_duration = None
         mirror_flag = False
 
@@ -254,47 +456,99 @@ class ICubBodyControl(yarp.RFModule):
                 delay = [g.replace("delay=", "") for g in args_list if "delay=" in g]
                 if len(delay) > 0:
                     init_duration = float(delay[0])
+        return mirror_flag, init_duration
 
-        # Convert gesture into ctp commands
-        print "Convert to ctp commands"
-        for part in [x for x in curr_action.keys() if x in self.parts]:
-            part_name = copy.deepcopy(part)
-            pos_offset = 0
-
-            print "Mirroring"
-            if mirror_flag and "arm" in part:
-                if part == "left_arm":
-                    part_name = "right_arm"
-                else:
-                    part_name = "left_arm"
+    def get_duration(self, action_name, init_duration=None):
+        if init_duration is None:
+            return self.gesture_info[action_name]['duration']
+        # A delay replaces the timing of the first waypoint of every part
+        curr_action = self.gestures_dict[action_name]
+        return max([init_duration + float(np.sum(curr_action[p]['durations'][1:]))
+                    for p in self.gesture_info[action_name]['parts']])
 
-            print "Calculating offset"
-            if part == "head":
-                pos_offset = self.getCurrPosition("head")
-            elif all(v == 0.0 for v in curr_action[part]['positions']):
-                pos_offset = self.getCurrPosition(part)
-            else:
-                pos_offset = None
+    def do_action(self, action_name, args=None):
+        bottle_list = dict()
+        curr_action = self.gestures_dict[action_name]
+        mirror_flag, init_duration = self.parse_move_args(args)
 
-            print "set duration"
+        # Convert gesture into ctp commands
+        for part in self.gesture_info[action_name]['parts']:
+            part_name = part
+            if mirror_flag and part == "left_arm":
+                part_name = "right_arm"
+            elif mirror_flag and part == "right_arm":
+                part_name = "left_arm"
+
+            durations = curr_action[part]['durations']
             if init_duration is not None:
-                curr_action[part]['durations'][0] = init_duration
-
-            msg_list[part_name] = self.construct_ctp_message(curr_action[part]['durations'],
-                                                             curr_action[part]['positions'],
-                                                             pos_offset)
-            print msg_list[part_name]
-        if args.get(0).asString() == "move":
-            self.send_ctp_messages(msg_list)
-        else:
-            return max([m[-1][0] for k, m in msg_list.iteritems()])
+                durations = np.concatenate(([init_duration], durations[1:]))
+
+            if part in self.gesture_info[action_name]['relative']:
+                pos_offset = self.getCurrPosition(part_name)
+                if pos_offset is None:
+                    print "Skipping", part_name, "of", action_name, "as its position is unknown"
+                    continue
+                bottle_list[part_name] = self.to_bottles(self.construct_ctp_message(durations,
+                                                                                    curr_action[part]['positions'],
+                                                                                    pos_offset))
+            else:
+                # Absolute trajectories are rendered once, a delay only re-renders the first waypoint
+                bottle_list[part_name] = self.get_ctp_bottles(action_name, part)
+                if init_duration is not None:
+                    bottle_list[part_name] = self.to_bottles(self.construct_ctp_message(
+                        durations[:1], curr_action[part]['positions'][:1])) + bottle_list[part_name][1:]
+        self.send_ctp_messages(bottle_list)
+
+    def get_ctp_bottles(self, action_name, part):
+        key = (action_name, part)
+        if key not in self.ctp_cache.keys():
+            self.ctp_cache[key] = self.to_bottles(self.construct_ctp_message(
+                self.gestures_dict[action_name][part]['durations'],
+                self.gestures_dict[action_name][part]['positions']))
+        return self.ctp_cache[key]
+
+    @staticmethod
+    def bottle_to_array(bottle):
+        joints = np.empty(bottle.size())
+        for p in range(bottle.size()):
+            joints[p] = bottle.get(p).asDouble()
+        return joints
+
+    def state_reader(self, part_name):
+        while not self.interrupted:
+            currPos = self.monitorPorts[part_name].read()
+            if currPos is None:
+                # read only returns nothing once the port is interrupted or closed
+                break
+            # (timestamp, joints) is replaced as a whole so readers never see a partial update
+            self.state_updates[part_name].acquire()
+            self.joint_state[part_name] = (time.time(), self.bottle_to_array(currPos))
+            self.state_updates[part_name].notify_all()
+            self.state_updates[part_name].release()
+
+    def get_state(self, part_name):
+        # Returns (age in seconds, joints) of the latest state or (None, None) if none received
+        state = self.joint_state.get(part_name)
+        if state is None:
+            return None, None
+        return time.time() - state[0], state[1]
 
     def getCurrPosition(self, part_name):
-        currPos = self.monitorPorts[part_name].read()
-        tuplePos = []
-        for p in range(currPos.size()):
-            tuplePos.append(round(currPos.get(p).asDouble(), 2))
-        return tuplePos
+        # Waits up to state_timeout for the reader to deliver a fresh state. None if there is none
+        age, joints = self.get_state(part_name)
+        if age is None or age > self.state_max_age:
+            print "State of", part_name, "is stale. Waiting for next update"
+            deadline = time.time() + self.state_timeout
+            self.state_updates[part_name].acquire()
+            age, joints = self.get_state(part_name)
+            while (age is None or age > self.state_max_age) and time.time() < deadline:
+                self.state_updates[part_name].wait(deadline - time.time())
+                age, joints = self.get_state(part_name)
+            self.state_updates[part_name].release()
+            if age is None or age > self.state_max_age:
+                print "No state received from", part_name
+                return None
+        return np.round(joints, 2)
 
     def interruptModule(self):
         print "Interrupting"
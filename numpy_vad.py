@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+from collections import deque
+import numpy as np
+
+
+class NumpyVAD(object):
+    # Voice activity detector that is both the audio source and the validator of an auditok
+    # StreamTokenizer. The wrapped source is read in blocks of block_frames analysis frames.
+    # Frame energies (dB, as auditok's AudioEnergyValidator) and optionally spectral flatness
+    # are computed for the whole block at once, and the frames are then handed out one at a
+    # time with their decision queued for is_valid.
+    #
+    # The threshold follows the noise floor: floor + margin, never below energy_threshold.
+    # The floor is tracked on the quietest frame of each block (minimum statistics). It drops
+    # at once and rises slowly (adapt_rate per block), so it follows steady hall noise while
+    # short bursts of speech barely move it.
+    #
+    # set_gate() raises the threshold to at least a given level while the robot is speaking, so
+    # its own voice picked up by the microphone is not taken for the user.
+    def __init__(self, audio_source, block_frames=5, energy_threshold=40, margin=12, adapt_rate=0.02,
+                 use_spectral=False, max_flatness=0.5):
+        self.audio_source = audio_source
+        self.block_frames = block_frames
+        self.energy_threshold = energy_threshold
+        self.margin = margin
+        self.adapt_rate = adapt_rate
+        self.use_spectral = use_spectral
+        self.max_flatness = max_flatness
+        self.sample_width = audio_source.get_sample_width()
+        self.dtype = {1: np.int8, 2: np.int16, 4: np.int32}[self.sample_width]
+        self.frame_bytes = None
+        self.noise_floor = None
+        self.threshold = energy_threshold
+        self.gate = None
+        self.frames = deque()
+        self.decisions = deque()
+
+    def __getattr__(self, name):
+        return getattr(self.audio_source, name)
+
+    def get_block_size(self):
+        return self.audio_source.get_block_size() // self.block_frames
+
+    def read(self):
+        if len(self.frames) == 0:
+            block = self.audio_source.read()
+            if block is None:
+                return None
+            self.process_block(block)
+        if len(self.frames) == 0:
+            return None
+        return self.frames.popleft()
+
+    def is_valid(self, frame):
+        if len(self.decisions) > 0:
+            return self.decisions.popleft()
+        # Frame did not come through read(), decide on it alone
+        return bool(self.compute_energies(frame)[0] > self.threshold)
+
+    def compute_energies(self, data, num_frames=1):
+        samples = np.frombuffer(data, dtype=self.dtype)
+        frame_samples = len(samples) // num_frames
+        frames = samples[:frame_samples * num_frames].reshape(num_frames, frame_samples).astype(np.float64)
+        return 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10), frames
+
+    @staticmethod
+    def spectral_flatness(frames):
+        spectrum = np.abs(np.fft.rfft(frames, axis=1)) + 1e-10
+        return np.exp(np.mean(np.log(spectrum), axis=1)) / np.mean(spectrum, axis=1)
+
+    def process_block(self, block):
+        if self.frame_bytes is None:
+            self.frame_bytes = len(block) // self.block_frames
+            self.frame_bytes -= self.frame_bytes % self.sample_width
+        num_frames = max(len(block) // self.frame_bytes, 1)
+        energies, frames = self.compute_energies(block[:num_frames * self.frame_bytes], num_frames)
+
+        self.update_threshold(energies)
+        decisions = energies > self.threshold
+        if self.use_spectral:
+            decisions &= self.spectral_flatness(frames) < self.max_flatness
+
+        for i in range(num_frames):
+            self.frames.append(block[i * self.frame_bytes:(i + 1) * self.frame_bytes])
+            self.decisions.append(bool(decisions[i]))
+
+    def update_threshold(self, energies):
+        quietest = float(np.min(energies))
+        if self.noise_floor is None or quietest < self.noise_floor:
+            self.noise_floor = quietest
+        else:
+            self.noise_floor += self.adapt_rate * (quietest - self.noise_floor)
+        self.threshold = max(self.energy_threshold, self.noise_floor + self.margin)
+        if self.gate is not None:
+            self.threshold = max(self.threshold, self.gate)
+
+    def set_gate(self, level):
+        # None removes the gate
+        self.gate = level
+        if level is not None:
+            self.threshold = max(self.threshold, level)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+
+class PrerollBuffer(object):
+    # Wraps an auditok data source and keeps the frames it reads in a fixed, preallocated ring,
+    # indexed the same way as StreamTokenizer numbers frames (0 for the first read of a
+    # tokenize call). get_preroll(start) returns the audio just before a token, which the
+    # energy threshold missed. capacity_frames must cover the longest token plus its trailing
+    # silence plus the pre-roll itself.
+    def __init__(self, audio_source, preroll_frames, capacity_frames):
+        self.audio_source = audio_source
+        self.preroll_frames = preroll_frames
+        self.capacity_frames = capacity_frames
+        self.frame_bytes = None
+        self.ring = None
+        self.lengths = [0] * capacity_frames
+        self.count = 0
+
+    def __getattr__(self, name):
+        return getattr(self.audio_source, name)
+
+    def reset(self):
+        # Called when a new tokenize call starts numbering frames from 0 again
+        self.count = 0
+
+    def read(self):
+        frame = self.audio_source.read()
+        if frame is not None:
+            if self.ring is None:
+                self.frame_bytes = len(frame)
+                self.ring = bytearray(self.frame_bytes * self.capacity_frames)
+            slot = self.count % self.capacity_frames
+            length = min(len(frame), self.frame_bytes)
+            pos = slot * self.frame_bytes
+            self.ring[pos:pos + length] = frame[:length]
+            self.lengths[slot] = length
+            self.count += 1
+        return frame
+
+    def get_preroll(self, start):
+        first = max(start - self.preroll_frames, self.count - self.capacity_frames, 0)
+        chunks = []
+        for i in range(first, min(start, self.count)):
+            slot = i % self.capacity_frames
+            pos = slot * self.frame_bytes
+            chunks.append(bytes(self.ring[pos:pos + self.lengths[slot]]))
+        return b''.join(chunks)
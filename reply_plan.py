@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import re
+
+
+class ReplyPlanCompiler(object):
+    # Compiles TalkML sayThis markup into an immutable plan, a tuple of (track, value, offset)
+    # segments that TimelineExecutor runs directly. Plans are memoized by reply text so a
+    # repeated reply is not parsed again.
+    #
+    #   "Hi <gesture>fast_long_wave</gesture> there <emotion>happy</emotion>"
+    #   -> (('speech', 'Hi', 0.0), ('gesture', 'fast_long_wave', 0.0), ('speech', 'there', 0.0),
+    #       ('emotion', 'happy', 0.0))
+    #
+    # Gestures and emotions that are not known are dropped, as are any other tags (<say> etc).
+    # Other text in angle brackets, such as "a < b and c > d", is spoken unchanged.
+    # The text after a gesture or emotion tag that is never closed is dropped up to the next tag,
+    # so "<gesture>nod<gesture>" is not spoken.
+    tag_re = re.compile(r"<\s*(\w+)\s*>((?:(?!<\s*\1\s*>).)*?)<\s*/\s*\1\s*>|<\s*/?\s*\w+\s*>", re.DOTALL)
+    open_re = re.compile(r"<\s*(gesture|emotion)\s*>$")
+
+    def __init__(self, actions, emotions, gesture_offset=0.0, emotion_offset=0.0, max_entries=500):
+        self.actions = set(actions)
+        self.emotions = set(emotions)
+        self.offsets = {'gesture': gesture_offset, 'emotion': emotion_offset}
+        self.max_entries = max_entries
+        self.plans = dict()
+
+    def compile(self, text):
+        plan = self.plans.get(text)
+        if plan is None:
+            plan = self.parse(text)
+            if len(self.plans) >= self.max_entries:
+                self.plans.clear()
+            self.plans[text] = plan
+        return plan
+
+    def parse(self, text):
+        plan = []
+        pos = 0
+        unclosed = None
+        for m in self.tag_re.finditer(text):
+            self.add_text(plan, text[pos:m.start()], unclosed)
+            pos = m.end()
+            tag = m.group(1)
+            opened = self.open_re.match(m.group(0))
+            if tag is None and opened is not None and unclosed != opened.group(1):
+                unclosed = opened.group(1)
+                continue
+            unclosed = None
+            if tag in ('gesture', 'emotion'):
+                value = ' '.join(m.group(2).split())
+                if self.validate(tag, value):
+                    plan.append((tag, value, self.offsets[tag]))
+            elif tag is not None:
+                # Content of other tags such as <say> is kept
+                for segment in self.parse(m.group(2)):
+                    if segment[0] == 'speech':
+                        self.add_speech(plan, segment[1])
+                    else:
+                        plan.append(segment)
+        self.add_text(plan, text[pos:], unclosed)
+        return tuple(plan)
+
+    def add_text(self, plan, text, unclosed):
+        if unclosed is None:
+            self.add_speech(plan, text)
+        elif text.strip() != '':
+            print "Unclosed", unclosed, "tag,", text.strip(), "dropped from reply"
+
+    def validate(self, tag, value):
+        if tag == 'gesture' and value not in self.actions:
+            print "Unknown gesture", value, "dropped from reply"
+            return False
+        if tag == 'emotion' and value not in self.emotions:
+            print "Unknown emotion", value, "dropped from reply"
+            return False
+        return True
+
+    @staticmethod
+    def add_speech(plan, text):
+        text = ' '.join(text.replace("/", "").split())
+        if text != '':
+            if len(plan) > 0 and plan[-1][0] == 'speech':
+                plan[-1] = ('speech', plan[-1][1] + ' ' + text, 0.0)
+            else:
+                plan.append(('speech', text, 0.0))
@@ -8,9 +8,21 @@ import numpy as np
 import yarp
 from auditok import ADSFactory, AudioEnergyValidator, StreamTokenizer, player_for
 import os
+import wave
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import snowboydecoder
 import speech_recognition as sr
+from audio_ring import AudioRing
+from audio_fanout import AudioFanout
+from numpy_vad import NumpyVAD
+from preroll_buffer import PrerollBuffer
+from turn_trace import TurnTracer, new_turn_id
+from hedged_asr import HedgedRecognizer, GoogleCloudBackend, DeepSpeechBackend, MockBackend
+
+from streaming_asr import StreamingAudioSource, GoogleStreamingRecognizer, DeepSpeechStreamForwarder, \
+    google_streaming_available
+
 warnings.simplefilter("ignore")
 np.set_printoptions(precision=2)
 
@@ -32,7 +44,18 @@ class sentence_tokenizer(yarp.RFModule):
         self.echo_enabled = False
         self.trigger_echo = False
         self.echo_thread = None
-        self.hotword_enabled = True
+        # With hotword detection on, tokens are dropped until the hotword is heard
+        self.hotword_enabled = False
+        self.hotword_heard = False
+
+        # The device is read once by the capture thread and fanned out to the tokenizer,
+        # hotword detection and recording, each reading from its own ring
+        self.capture = None
+        self.hotword_source = None
+        self.hotword_thread = None
+        self.record_file = None
+        self.record_source = None
+        self.record_thread = None
 
         # Hotword settings
         self.hotword_sensitivity = 0.5
@@ -49,14 +72,68 @@ class sentence_tokenizer(yarp.RFModule):
         self.tok_max_len = int(5 * self.tok_window_rate)
         self.tok_max_silence_duration = 0.7 * self.tok_window_rate
         self.tokenizer_mode = None
+
+        # Audio before the detected start of a token is prepended to it
+        self.preroll_duration = 0.3
+        self.preroll = None
+
+        # VAD: 'numpy' for the block vectorised adaptive detector, 'auditok' for the fixed threshold
+        self.vad_mode = 'numpy'
+        self.vad_block_frames = 5
+        self.vad_margin = 12
+        self.vad_spectral = False
+
+        # While the robot speaks the VAD threshold is raised above the level its own voice reaches
+        # the microphone. Levels of played audio are given in dBFS, the coupling is the loss from
+        # the played file to the microphone
+        self.self_speech_level = -20.
+        self.self_speech_coupling = -30.
+        self.self_speech_margin = 6.
         self.bdata = None
         self.google_credentials = None
 
         # Google ASR
         self.use_google = True
         self.asr = None
+        self.google_credentials_file = 'google_credentials.json'
+
+        # Hedged ASR sends each utterance to all backends and takes the first confident result
+        self.use_hedged = False
+        self.hedged_asr = None
+        self.asr_backends = ['google', 'deepspeech']
+        self.hedge_deadline = 3.0
+        self.hedge_min_confidence = 0.7
+
+        # Streaming ASR emits partial results while the user is still speaking
+        self.use_streaming = False
+        self.streaming_recognizer = None
+        self.stream_active = False
+        self.stream_history_frames = int(0.3 * self.tok_window_rate)
+        self.port_lock = threading.Lock()
+
+        # With audio_transport shm, utterances for deepSpeechToText go through a shared memory
+        # ring when it runs on the same machine, otherwise they are sent in the bottle
+        self.audio_transport = 'bottle'
+        self.audio_ring = None
+        self.audio_ring_file = '/dev/shm/sentence_tokenizer_audio'
         self.time_total = 0
         self.num_recs = 0
+
+        # Cloud recognition runs on a pool so the tokenizer never waits on the network.
+        # Results are written in utterance order and tagged with their sequence id
+        self.asr_workers = 3
+        self.asr_max_inflight = 6
+        self.asr_executor = None
+        self.asr_seq = 0
+        self.asr_next_seq = 1
+        self.asr_inflight = 0
+        self.asr_results = dict()
+        self.asr_lock = threading.Lock()
+
+        # Every utterance gets a turn id that is appended to the bottles sent for it
+        self.tracer = None
+        self.trace_file = None
+        self.turn_id = None
         self.phrases = ["Hello i cub",
                         "Goodbye i cub",
                         "i cub",
@@ -64,6 +141,46 @@ class sentence_tokenizer(yarp.RFModule):
                         "Daniel"]
 
     def configure(self, rf):
+        streaming_val = rf.find('streaming').toString_c().lower()
+        if streaming_val != '':
+            self.use_streaming = streaming_val == 'true'
+        if self.use_streaming and self.use_google and not google_streaming_available:
+            print "Streaming Google recognition requires google-cloud-speech. Disabled"
+            self.use_streaming = False
+
+        hedged_val = rf.find('hedged').toString_c().lower()
+        if hedged_val != '':
+            self.use_hedged = hedged_val == 'true'
+
+        backends_val = rf.find('asr_backends').toString_c().lower()
+        if backends_val != '':
+            self.asr_backends = backends_val.split(',')
+
+        vad_val = rf.find('vad').toString_c().lower()
+        if vad_val != '':
+            self.vad_mode = vad_val
+
+        transport_val = rf.find('audio_transport').toString_c().lower()
+        if transport_val != '':
+            self.audio_transport = transport_val
+
+        preroll_val = rf.find('preroll_ms').toString_c()
+        if preroll_val != '':
+            self.preroll_duration = float(preroll_val) / 1000.
+
+        hotword_val = rf.find('hotword').toString_c().lower()
+        if hotword_val != '':
+            self.hotword_enabled = hotword_val == 'true'
+
+        record_val = rf.find('record_file').toString_c()
+        if record_val != '':
+            self.record_file = record_val
+
+        trace_val = rf.find('trace_file').toString_c()
+        if trace_val != '':
+            self.trace_file = trace_val
+        self.tracer = TurnTracer('sentence_tokenizer', self.trace_file)
+
         # Setting up rpc port
         self.portsList["rpc"] = yarp.Port()
         self.portsList["rpc"].open("/sentence_tokenizer/rpc:i")
@@ -72,13 +189,40 @@ class sentence_tokenizer(yarp.RFModule):
         self.portsList["audio_out"] = yarp.BufferedPortBottle()
         self.portsList["audio_out"].open("/sentence_tokenizer/audio:o")
 
-        # Setting up hotword detection
-        self.hotword_detector = snowboydecoder.HotwordDetector(self.hotword_model, sensitivity=self.hotword_sensitivity)
+        # Audio chunks of streamed utterances only go to deepSpeechToText
+        self.portsList["stream_out"] = yarp.BufferedPortBottle()
+        self.portsList["stream_out"].open("/sentence_tokenizer/stream:o")
+        yarp.Network.connect(self.portsList["stream_out"].getName(), "/deepSpeechToText:rpc:i")
+
+        # Setting up hotword detection. The detector is fed from the capture thread instead of
+        # opening its own stream on the microphone
+        self.hotword_detector = snowboydecoder.snowboydetect.SnowboyDetect(
+            resource_filename=snowboydecoder.RESOURCE_FILE.encode(), model_str=self.hotword_model.encode())
+        self.hotword_detector.SetAudioGain(1)
+        self.hotword_detector.SetSensitivity(str(self.hotword_sensitivity).encode())
 
         # Setting up audio tokenizer to split sentences
-        self.audio_source = ADSFactory.ads(record=True, max_time=self.tok_record_duration, block_dur=self.tok_window)
-        self.tok_validator = AudioEnergyValidator(sample_width=self.audio_source.get_sample_width(),
-                                                  energy_threshold=self.tok_energy_threshold)
+        if self.vad_mode == 'numpy':
+            # Device is read in blocks of several windows, NumpyVAD hands them out one window at a time
+            device = ADSFactory.ads(record=False, max_time=self.tok_record_duration,
+                                    block_dur=self.tok_window * self.vad_block_frames)
+            self.capture = AudioFanout(device)
+            self.audio_source = NumpyVAD(self.capture.add_consumer(), block_frames=self.vad_block_frames,
+                                         energy_threshold=self.tok_energy_threshold, margin=self.vad_margin,
+                                         use_spectral=self.vad_spectral)
+            self.tok_validator = self.audio_source
+        else:
+            device = ADSFactory.ads(record=False, max_time=self.tok_record_duration, block_dur=self.tok_window)
+            self.capture = AudioFanout(device)
+            self.audio_source = self.capture.add_consumer()
+            self.tok_validator = AudioEnergyValidator(sample_width=self.audio_source.get_sample_width(),
+                                                      energy_threshold=self.tok_energy_threshold)
+        preroll_frames = int(self.preroll_duration * self.tok_window_rate)
+        self.preroll = PrerollBuffer(self.audio_source, preroll_frames,
+                                     preroll_frames + self.tok_max_len + int(self.tok_max_silence_duration) + 10)
+        self.audio_source = self.preroll
+        if self.use_streaming:
+            self.audio_source = StreamingAudioSource(self.audio_source, self.stream_history_frames)
         self.tokenizer_mode = StreamTokenizer.DROP_TRAILING_SILENCE
         self.tokenizer = StreamTokenizer(validator=self.tok_validator,
                                          min_length=self.tok_min_len,
@@ -86,86 +230,280 @@ class sentence_tokenizer(yarp.RFModule):
                                          max_continuous_silence=self.tok_max_silence_duration,
                                          mode=self.tokenizer_mode)
 
+        if not self.use_google and not self.use_hedged and self.audio_transport == 'shm':
+            if self.is_local("/deepSpeechToText:rpc:i"):
+                self.audio_ring = AudioRing(self.audio_ring_file, create=True)
+            else:
+                print "deepSpeechToText is not running on this machine. Sending audio in bottles"
+
         if self.echo_enabled:
             self.echo_thread = threading.Thread(target=self.replayAudio)
             self.echo_thread.start()
 
+        if self.record_file is not None:
+            self.record_source = self.capture.add_consumer(5.0)
+            self.record_thread = threading.Thread(target=self.recordAudio)
+            self.record_thread.daemon = True
+            self.record_thread.start()
+
+        if self.hotword_enabled and device.get_sampling_rate() != self.hotword_detector.SampleRate():
+            print "Hotword detection needs", self.hotword_detector.SampleRate(), "Hz audio. Disabled"
+            self.hotword_enabled = False
+
         if self.hotword_enabled:
+            # Tokens are dropped until the hotword is heard
             print("Waiting for hotword to start interaction")
-            # self.hotword_detector.start(detected_callback=self.detected_callback,
-            #                             interrupt_check=self.interrupt_callback,
-            #                             sleep_time=self.hotword_loop_time)
-            print("Hotword detected. Starting tokenizer thread")
+            self.hotword_source = self.capture.add_consumer()
+            self.hotword_thread = threading.Thread(target=self.hotwordThread)
+            self.hotword_thread.daemon = True
+            self.hotword_thread.start()
         else:
             print "Starting tokenizer thread"
+        self.capture.start()
 
         self.asr = sr.Recognizer()
+        self.asr_executor = ThreadPoolExecutor(max_workers=self.asr_workers)
 
-        with open('google_credentials.json', 'r') as credentials:
+        with open(self.google_credentials_file, 'r') as credentials:
             self.google_credentials = credentials.read()
+
+        if self.use_hedged:
+            backends = []
+            for b in self.asr_backends:
+                if b == 'google':
+                    backends.append(GoogleCloudBackend(self.google_credentials, self.phrases))
+                elif b == 'deepspeech':
+                    backends.append(DeepSpeechBackend())
+                elif b == 'mock':
+                    backends.append(MockBackend())
+                else:
+                    print "Unknown ASR backend", b, "skipped"
+            self.hedged_asr = HedgedRecognizer(backends, self.hedge_deadline, self.hedge_min_confidence)
+
+        if self.use_streaming and not self.use_google:
+            # deepSpeechToText decodes the forwarded stream and publishes partial/spoken itself
+            self.streaming_recognizer = DeepSpeechStreamForwarder(self.write_stream_out,
+                                                                  self.audio_source.get_sampling_rate())
+        elif self.use_streaming:
+            self.streaming_recognizer = GoogleStreamingRecognizer(self.google_credentials_file,
+                                                                  self.audio_source.get_sampling_rate(),
+                                                                  language="en-GB",
+                                                                  phrases=self.phrases,
+                                                                  on_partial=self.partial_callback,
+                                                                  on_final=self.final_callback)
         return True
 
     def detected_callback(self):
         print("Hotword 'Hello iCub' detected")
-        self.interrupted = True
+        self.hotword_heard = True
+
+    def hotwordThread(self):
+        while not self.hotword_heard:
+            # Everything captured since the last pass is checked at once
+            frames = [self.hotword_source.read()]
+            if frames[0] is None:
+                break
+            while self.hotword_source.available() > 0:
+                frames.append(self.hotword_source.read())
+            ans = self.hotword_detector.RunDetection(b''.join(frames))
+            if ans == -1:
+                print "Error reading audio data for hotword detection"
+            elif ans > 0:
+                self.detected_callback()
+                print("Hotword detected. Starting tokenizer thread")
+        self.capture.remove_consumer(self.hotword_source)
+
+    def recordAudio(self):
+        wav = wave.open(self.record_file, 'wb')
+        wav.setnchannels(self.audio_source.get_channels())
+        wav.setsampwidth(self.audio_source.get_sample_width())
+        wav.setframerate(self.audio_source.get_sampling_rate())
+        while True:
+            frame = self.record_source.read()
+            if frame is None:
+                break
+            wav.writeframes(frame)
+        wav.close()
+
+    def write_audio_out(self, keyword, *values):
+        self.write_port("audio_out", keyword, *values)
+
+    def write_stream_out(self, keyword, *values):
+        self.write_port("stream_out", keyword, *values)
+
+    def write_port(self, port, keyword, *values):
+        self.port_lock.acquire()
+        audio_bottle = self.portsList[port].prepare()
+        audio_bottle.clear()
+        audio_bottle.addString(keyword)
+        for v in values:
+            if v is None:
+                continue
+            elif isinstance(v, int):
+                audio_bottle.addInt(v)
+            else:
+                audio_bottle.addString(str(v))
+        # Strict so consecutive stream chunks are queued instead of overwriting each other
+        self.portsList[port].writeStrict()
+        self.port_lock.release()
+
+    def partial_callback(self, sentence):
+        print "Partial:", sentence
+        self.write_audio_out("partial", sentence)
+
+    def final_callback(self, sentence):
+        print "Final:", sentence
+        self.write_audio_out("spoken", sentence, self.turn_id)
+
+    def start_stream(self):
+        if not self.stream_active and not self.pause_tokenizer:
+            self.stream_active = True
+            self.streaming_recognizer.start()
+            self.audio_source.attach(self.streaming_recognizer.feed, self.stream_history_frames)
+
+    def stop_stream(self):
+        if self.stream_active:
+            self.audio_source.detach()
+            self.streaming_recognizer.finish()
+            self.stream_active = False
 
     def tok_callback(self, data, start, end, starting=False):
+        if self.hotword_enabled and not self.hotword_heard:
+            return
         if data is None:
+            if self.use_streaming:
+                if starting:
+                    self.start_stream()
+                else:
+                    self.stop_stream()
 
-            audio_bottle = self.portsList["audio_out"].prepare()
-            audio_bottle.clear()
-            audio_bottle.addString("speaking")
             if starting:
                 print "Speaking start"
-                audio_bottle.addString("start")
+                self.turn_id = new_turn_id()
+                self.write_audio_out("speaking", "start", self.turn_id)
             else:
                 print "Speaking stop"
-                audio_bottle.addString("stop")
-            self.portsList["audio_out"].write()
+                self.write_audio_out("speaking", "stop", self.turn_id)
+        elif self.use_streaming:
+            print("Acoustic activity at: {0}--{1}".format(start, end))
+            # Audio has already been streamed, closing the stream triggers the final result
+            self.stop_stream()
         else:
             print("Acoustic activity at: {0}--{1}".format(start, end))
             # print "Chunk segmented", time.time()
             # print "Pause value is: ", self.pause_tokenizer
             if not self.pause_tokenizer:
-                self.bdata = b''.join(data)
-
-                if self.use_google:
-                    audio = sr.AudioData(self.bdata, self.audio_source.get_sampling_rate(),
-                                         self.audio_source.get_sample_width())
-                    t3 = time.time()
-                    try:
-
-                        sentence = self.asr.recognize_google_cloud(audio_data=audio,
-                                                                   credentials_json=self.google_credentials,
-                                                                   language="en-UK",
-                                                                   preferred_phrases=self.phrases)
-
-                        t4 = time.time()
-                        dur = t4 - t3
-                        self.time_total += dur
-                        self.num_recs += 1
-                        print sentence, " | Time taken=", dur, " | Mean Time=", self.time_total/self.num_recs
-                        audio_bottle = self.portsList["audio_out"].prepare()
-                        audio_bottle.clear()
-                        audio_bottle.addString("spoken")
-                        audio_bottle.addString(str(sentence))
-                        self.portsList["audio_out"].write()
-                    except sr.UnknownValueError:
-                        print("Google Speech Recognition could not understand audio")
-                    except sr.RequestError as e:
-                        print("Could not request results from Google Speech Recognition service; {0}".format(e))
+                if self.turn_id is None:
+                    self.turn_id = new_turn_id()
+                turn_id = self.turn_id
+                self.turn_id = None
+                # The token is closed after the trailing silence read since its last frame
+                now = time.time()
+                self.tracer.record(turn_id, 'vad_close', now - (self.preroll.count - 1 - end) * self.tok_window, now)
+
+                data = [self.preroll.get_preroll(start)] + data
+                if self.audio_ring is not None and self.audio_ring.fits(data):
+                    # Frames are copied once, straight into shared memory
+                    offset, length, seq = self.audio_ring.write(data)
+                    self.write_audio_out("classify_shm", self.audio_ring_file, offset, length, str(seq),
+                                         self.audio_source.get_sampling_rate(),
+                                         self.audio_source.get_sample_width(),
+                                         self.audio_source.get_channels(), turn_id)
+                    if self.echo_enabled:
+                        self.bdata = b''.join(data)
                 else:
-                    audio_bottle = self.portsList["audio_out"].prepare()
-                    audio_bottle.clear()
-                    audio_bottle.addString("classify")
-                    audio_bottle.addString(self.bdata)
-                    audio_bottle.addInt(self.audio_source.get_sampling_rate())
-                    self.portsList["audio_out"].write()
+                    self.bdata = b''.join(data)
+                    if self.use_google or self.use_hedged:
+                        self.submit_recognition(self.bdata, turn_id)
+                    else:
+                        self.write_audio_out("classify", self.bdata, self.audio_source.get_sampling_rate(),
+                                             turn_id)
 
                 if self.echo_enabled:
                     self.trigger_echo = True
 
+    def is_local(self, port_name):
+        # True if port_name is registered from the same host as this module
+        remote = yarp.Network.queryName(port_name)
+        local = yarp.Network.queryName(self.portsList["audio_out"].getName())
+        return remote.isValid() and local.isValid() and remote.getHost() == local.getHost()
+
+    def submit_recognition(self, bdata, turn_id=None):
+        self.asr_lock.acquire()
+        if self.asr_inflight >= self.asr_max_inflight:
+            self.asr_lock.release()
+            print "Too many recognitions in flight. Utterance dropped"
+            return
+        self.asr_inflight += 1
+        self.asr_seq += 1
+        seq = self.asr_seq
+        self.asr_lock.release()
+        self.asr_executor.submit(self.recognition_worker, seq, bdata, turn_id)
+
+    def recognition_worker(self, seq, bdata, turn_id=None):
+        sentence = None
+        t0 = time.time()
+        try:
+            if self.use_hedged:
+                sentence = self.hedged_asr.recognize(bdata, self.audio_source.get_sampling_rate(),
+                                                     self.audio_source.get_sample_width())
+            else:
+                sentence = self.recognize_google(bdata)
+        except Exception as e:
+            print "Recognition", seq, "failed:", e
+        self.tracer.record(turn_id, 'asr', t0)
+        self.deliver_recognition(seq, sentence, turn_id)
+
+    def recognize_google(self, bdata):
+        audio = sr.AudioData(bdata, self.audio_source.get_sampling_rate(), self.audio_source.get_sample_width())
+        t3 = time.time()
+        try:
+            sentence = self.asr.recognize_google_cloud(audio_data=audio,
+                                                       credentials_json=self.google_credentials,
+                                                       language="en-UK",
+                                                       preferred_phrases=self.phrases)
+        except sr.UnknownValueError:
+            print("Google Speech Recognition could not understand audio")
+            return None
+        except sr.RequestError as e:
+            print("Could not request results from Google Speech Recognition service; {0}".format(e))
+            return None
+        t4 = time.time()
+        dur = t4 - t3
+        self.time_total += dur
+        self.num_recs += 1
+        print sentence, " | Time taken=", dur, " | Mean Time=", self.time_total/self.num_recs
+        return sentence
+
+    def deliver_recognition(self, seq, sentence, turn_id=None):
+        # A result is held back until every earlier utterance has been delivered or failed
+        self.asr_lock.acquire()
+        self.asr_results[seq] = (sentence, turn_id)
+        self.asr_inflight -= 1
+        while self.asr_next_seq in self.asr_results.keys():
+            curr_sentence, curr_turn_id = self.asr_results.pop(self.asr_next_seq)
+            if curr_sentence is not None:
+                self.write_audio_out("spoken", curr_sentence, self.asr_next_seq, curr_turn_id)
+            self.asr_next_seq += 1
+        self.asr_lock.release()
+
+    def set_self_speech(self, level):
+        # level of the robot's speech in dBFS, None when it stops speaking
+        if level is None:
+            gate = None
+        else:
+            full_scale = 20 * np.log10(2 ** (8 * self.audio_source.get_sample_width() - 1))
+            gate = level + full_scale + self.self_speech_coupling + self.self_speech_margin
+            print "Self speech gate at", gate, "dB"
+        if self.vad_mode == 'numpy':
+            self.tok_validator.set_gate(gate)
+        elif gate is None:
+            self.tok_validator.set_energy_threshold(self.tok_energy_threshold)
+        else:
+            self.tok_validator.set_energy_threshold(max(self.tok_energy_threshold, gate))
+
     def tokenizerThread(self):
+        self.preroll.reset()
         self.audio_source.open()
         self.tokenizer.tokenize(self.audio_source, callback=self.tok_callback)
 
@@ -180,8 +518,20 @@ class sentence_tokenizer(yarp.RFModule):
     def close(self):
         print('Exiting ...')
         time.sleep(2)
-        self.hotword_detector.terminate()
         self.audio_source.close()
+        self.capture.stop()
+
+        if self.asr_executor is not None:
+            self.asr_executor.shutdown(wait=False)
+
+        if self.hedged_asr is not None:
+            self.hedged_asr.close()
+
+        if self.audio_ring is not None:
+            self.audio_ring.close()
+
+        if self.tracer is not None:
+            self.tracer.close()
 
         if self.echo_enabled:
             self.player.stop()
@@ -211,6 +561,32 @@ class sentence_tokenizer(yarp.RFModule):
             self.pause_tokenizer = False
             print "resuming tokenizer sending"
             reply.addString('ack')
+        elif action == "self_speech":
+            # self_speech on [level dBFS] | self_speech off
+            if command.get(1).asString() == "off":
+                self.set_self_speech(None)
+            elif command.size() > 2:
+                self.set_self_speech(command.get(2).asDouble())
+            else:
+                self.set_self_speech(self.self_speech_level)
+            reply.addString('ack')
+        elif action == "trace_stats":
+            self.tracer.add_stats(reply)
+        elif action == "asr_stats":
+            # ack (backend count wins failures p50 p95 p99) ...
+            if self.hedged_asr is None:
+                reply.addString('nack')
+                reply.addString('hedged ASR disabled')
+            else:
+                reply.addString('ack')
+                stats = self.hedged_asr.stats()
+                for name in sorted(stats.keys()):
+                    backend_bottle = reply.addList()
+                    backend_bottle.addString(name)
+                    for k in ['count', 'wins', 'failures']:
+                        backend_bottle.addInt(stats[name][k])
+                    for k in ['p50', 'p95', 'p99']:
+                        backend_bottle.addDouble(stats[name][k])
         # -------------------------------------------------
         elif action == "EXIT":
             reply.addString('ack')
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import threading
+import Queue
+import uuid
+from collections import deque
+
+try:
+    from google.cloud import speech
+    from google.cloud.speech import enums
+    from google.cloud.speech import types
+    from google.oauth2 import service_account
+    google_streaming_available = True
+except ImportError:
+    google_streaming_available = False
+
+
+class StreamingAudioSource(object):
+    # Wraps an auditok data source and hands every frame read by the tokenizer to a listener,
+    # so recognition can run on audio as it is captured rather than on the finished token.
+    # The last few frames are kept so the start of a token is not lost when the listener is
+    # only told about speech after the tokenizer has already consumed them.
+    def __init__(self, audio_source, history_frames=50):
+        self.audio_source = audio_source
+        self.listener = None
+        self.history = deque(maxlen=history_frames)
+
+    def __getattr__(self, name):
+        return getattr(self.audio_source, name)
+
+    def read(self):
+        frame = self.audio_source.read()
+        if frame is not None:
+            self.history.append(frame)
+            if self.listener is not None:
+                self.listener(frame)
+        return frame
+
+    def attach(self, listener, num_history=0):
+        if num_history > 0:
+            for frame in list(self.history)[-num_history:]:
+                listener(frame)
+        self.listener = listener
+
+    def detach(self):
+        self.listener = None
+
+
+class GoogleStreamingRecognizer(object):
+    # One streaming_recognize call per utterance: start() opens it, feed() pushes audio and
+    # finish() closes the request stream. Interim results go to on_partial and the final
+    # transcript to on_final, both from the recognition thread.
+    def __init__(self, credentials_file, sampling_rate, language="en-GB", phrases=None,
+                 on_partial=None, on_final=None):
+        credentials = service_account.Credentials.from_service_account_file(credentials_file)
+        self.client = speech.SpeechClient(credentials=credentials)
+        recognition_config = types.RecognitionConfig(
+            encoding=enums.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=sampling_rate,
+            language_code=language,
+            speech_contexts=[types.SpeechContext(phrases=phrases or [])])
+        self.config = types.StreamingRecognitionConfig(config=recognition_config,
+                                                       interim_results=True,
+                                                       single_utterance=False)
+        self.on_partial = on_partial
+        self.on_final = on_final
+        self.chunks = None
+        self.thread = None
+
+    def start(self):
+        self.chunks = Queue.Queue()
+        self.thread = threading.Thread(target=self.recognize, args=(self.chunks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self, chunk):
+        if self.chunks is not None:
+            self.chunks.put(chunk)
+
+    def finish(self):
+        if self.chunks is not None:
+            self.chunks.put(None)
+            self.chunks = None
+
+    @staticmethod
+    def request_generator(chunks):
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            yield types.StreamingRecognizeRequest(audio_content=chunk)
+
+    def recognize(self, chunks):
+        final_text = ''
+        try:
+            responses = self.client.streaming_recognize(self.config, self.request_generator(chunks))
+            for response in responses:
+                for result in response.results:
+                    if len(result.alternatives) == 0:
+                        continue
+                    text = result.alternatives[0].transcript.strip()
+                    if result.is_final:
+                        final_text = (final_text + ' ' + text).strip()
+                    elif self.on_partial is not None:
+                        self.on_partial((final_text + ' ' + text).strip())
+        except Exception as e:
+            print "Streaming recognition failed:", e
+        if self.on_final is not None and final_text != '':
+            self.on_final(final_text)
+
+
+class DeepSpeechStreamForwarder(object):
+    # Same interface as GoogleStreamingRecognizer but forwards the audio to deepSpeechToText
+    # as stream_start/stream_feed/stream_finish bottles. Frames are grouped into chunks of
+    # chunk_frames to limit the number of bottles. send(*values) writes one bottle.
+    def __init__(self, send, sampling_rate, chunk_frames=10):
+        self.send = send
+        self.sampling_rate = sampling_rate
+        self.chunk_frames = chunk_frames
+        self.utterance_id = None
+        self.frames = []
+
+    def start(self):
+        self.utterance_id = uuid.uuid4().hex
+        self.frames = []
+        self.send("stream_start", self.utterance_id, self.sampling_rate)
+
+    def feed(self, chunk):
+        if self.utterance_id is not None:
+            self.frames.append(chunk)
+            if len(self.frames) >= self.chunk_frames:
+                self.flush()
+
+    def flush(self):
+        if len(self.frames) > 0:
+            self.send("stream_feed", self.utterance_id, b''.join(self.frames))
+            self.frames = []
+
+    def finish(self):
+        if self.utterance_id is not None:
+            self.flush()
+            self.send("stream_finish", self.utterance_id)
+            self.utterance_id = None
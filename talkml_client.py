@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import time
+import requests
+import simplejson
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TalkMLClient(object):
+    def __init__(self, url, headers, deadlines=None, pool_size=4, max_workers=2):
+        self.url = url
+        self.headers = dict(headers)
+
+        # Per-action deadlines in seconds as (connect, read)
+        self.deadlines = dict()
+        self.deadlines['upload'] = (3.05, 20)
+        self.deadlines['start'] = (3.05, 10)
+        self.deadlines['heard'] = (3.05, 5)
+        self.deadlines['noinput'] = (3.05, 5)
+        self.deadlines['nomatch'] = (3.05, 5)
+        self.deadlines['getSayNext'] = (3.05, 5)
+        self.deadlines['default'] = (3.05, 10)
+        if deadlines is not None:
+            self.deadlines.update(deadlines)
+
+        # Keep-alive session so every dialog turn reuses the same TCP/TLS connection
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get_deadline(self, action):
+        if action in self.deadlines.keys():
+            return self.deadlines[action]
+        else:
+            return self.deadlines['default']
+
+    def set_header(self, key, value):
+        self.headers[key] = value
+        self.session.headers[key] = value
+
+    def send(self, message):
+        deadline = self.get_deadline(message.get("action"))
+        t0 = time.time()
+        try:
+            reply = self.session.post(self.url, data=simplejson.dumps(message), timeout=deadline)
+        except requests.exceptions.Timeout:
+            print "TalkML", message.get("action"), "timed out after", time.time() - t0
+            return None
+        except requests.exceptions.RequestException as e:
+            print "TalkML", message.get("action"), "failed:", e
+            return None
+        print "TalkML", message.get("action"), "took", time.time() - t0
+        return reply
+
+    def send_async(self, message):
+        # Returns a concurrent.futures.Future resolving to the reply (or None on failure)
+        return self.executor.submit(self.send, message)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+# Local stand-in for the TalkML service, for running the dialog without the live server.
+# Implements the JSON protocol bbc_demo uses (upload, start, heard, noinput, nomatch,
+# getSayNext) with sessions keyed by the DId and SId headers, and interprets the uploaded
+# .tkml script. Every reply can be delayed by latency +- jitter seconds. Sessions that get no
+# request for session_timeout seconds are dropped.
+#
+# usage: python talkml_server.py [--port 8000] [--latency 0.2] [--jitter 0.05] [--tkml file]
+#   --tkml preloads a script for every DId, so clients can start without uploading
+
+import sys
+import time
+import json
+import random
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from xml.etree import ElementTree as ET
+
+
+actions = ['upload', 'start', 'heard', 'noinput', 'nomatch', 'getSayNext']
+
+
+class TKMLError(Exception):
+    pass
+
+
+class TKMLScript(object):
+    # Plans by name, the triggers that start them and the top level items of the script.
+    # Raises ET.ParseError for malformed xml and TKMLError for a script the server cannot run
+    def __init__(self, tkml):
+        # Uploads arrive as unicode from json, the parser wants the encoded document
+        if isinstance(tkml, unicode):
+            tkml = tkml.encode('utf-8')
+        root = ET.fromstring(tkml)
+        for element in root.iter():
+            cond = element.get('cond')
+            if cond is not None and '==' not in cond:
+                raise TKMLError("cond '" + cond + "' of <" + element.tag + "> is not name == value")
+        self.plans = dict()
+        self.triggers = dict()
+        for plan in root.findall('plan'):
+            self.plans[plan.get('achieves')] = plan
+            if plan.get('trigger') is not None:
+                self.triggers[plan.get('trigger')] = plan.get('achieves')
+        self.main = [n for n in self.items(root) if not (ET.iselement(n) and n.tag in ['plan', 'achieves'])]
+
+    @staticmethod
+    def items(element):
+        # Text and child elements of an element in document order
+        items = []
+        if element.text is not None and element.text.strip() != '':
+            items.append(element.text)
+        for child in element:
+            items.append(child)
+            if child.tail is not None and child.tail.strip() != '':
+                items.append(child.tail)
+        return items
+
+
+class TKMLSession(object):
+    # Walks the script one say at a time with a stack of [items, index, is_plan] frames. A say
+    # with recognise waits for heard/nomatch/noinput, anything else is returned on getSayNext.
+    # heard with one of the say's grammars stores it under resultId; heard with the trigger of
+    # a plan runs that plan (once) and then carries on after the say.
+    def __init__(self, script):
+        self.script = script
+        self.stack = [[script.main, 0, False]]
+        self.variables = dict()
+        self.triggers = dict(script.triggers)
+        self.waiting = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def markup(element):
+        text = element.text or ''
+        for child in element:
+            text += ET.tostring(child)
+        return ' '.join(text.split())
+
+    def condition(self, cond):
+        if cond is None:
+            return True
+        name, value = cond.split('==', 1)
+        return self.variables.get(name.strip()) == value.strip()
+
+    def branch(self, element):
+        # Items of the first branch of an <if> whose condition holds
+        branches = [[element.get('cond'), []]]
+        for item in self.script.items(element):
+            if ET.iselement(item) and item.tag == 'elseif':
+                branches.append([item.get('cond'), []])
+            elif ET.iselement(item) and item.tag == 'else':
+                branches.append([None, []])
+            else:
+                branches[-1][1].append(item)
+        for cond, items in branches:
+            if self.condition(cond):
+                return items
+        return []
+
+    def push_plan(self, name):
+        if name in self.script.plans.keys():
+            self.stack.append([self.script.items(self.script.plans[name]), 0, True])
+
+    def advance(self):
+        # Next say as (text, recognise, resultId), None at the end of the script
+        while len(self.stack) > 0:
+            frame = self.stack[-1]
+            if frame[1] >= len(frame[0]):
+                self.stack.pop()
+                continue
+            item = frame[0][frame[1]]
+            frame[1] += 1
+            if not ET.iselement(item):
+                return ' '.join(item.split()), None, None
+            elif item.tag == 'say':
+                return self.markup(item), item.get('recognise'), item.get('resultId')
+            elif item.tag in ['gesture', 'emotion']:
+                return ET.tostring(item).strip(), None, None
+            elif item.tag == 'if':
+                self.stack.append([self.branch(item), 0, False])
+            elif item.tag == 'achieve':
+                self.push_plan(item.get('goal'))
+            elif item.tag == 'exit':
+                self.stack = []
+            elif item.tag == 'success':
+                # Leaves the plan being run
+                while len(self.stack) > 0 and not self.stack.pop()[2]:
+                    pass
+        return None
+
+    def reply(self, say):
+        self.waiting = None
+        if say is None:
+            return {'sayThis': '', 'g1': '', 'g2': ''}
+        text, recognise, result_id = say
+        if recognise is None:
+            return {'sayThis': text, 'g1': '', 'g2': ''}
+        self.waiting = say
+        return {'sayThis': text, 'g1': recognise, 'g2': '|'.join(sorted(self.triggers.keys()))}
+
+    def handle(self, request):
+        action = request.get('action')
+        self.lock.acquire()
+        try:
+            if action == 'heard' and self.waiting is not None:
+                grammar = request.get('grammar')
+                _, recognise, result_id = self.waiting
+                if grammar in recognise.split('|'):
+                    if result_id is not None:
+                        self.variables[result_id] = grammar
+                elif grammar in self.triggers.keys():
+                    self.push_plan(self.triggers.pop(grammar))
+                return self.reply(self.advance())
+            elif action == 'noinput' and self.waiting is not None:
+                # Asked again
+                return self.reply(self.waiting)
+            else:
+                # start, getSayNext, nomatch, or input while not waiting for any: carry on
+                return self.reply(self.advance())
+        finally:
+            self.lock.release()
+
+
+class TalkMLServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, tkml=None, session_timeout=600.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, TalkMLHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.session_timeout = session_timeout
+        self.default_script = None
+        if tkml is not None:
+            self.default_script = TKMLScript(tkml)
+        self.scripts = dict()
+        # (DId, SId) -> [session, time of last request]
+        self.sessions = dict()
+        self.last_expiry = time.time()
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def delay(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def expire_sessions(self, now):
+        # Called with the lock held, scans at most once per second
+        if now - self.last_expiry < 1.0:
+            return
+        self.last_expiry = now
+        for key in [k for k in self.sessions.keys() if now - self.sessions[k][1] > self.session_timeout]:
+            del self.sessions[key]
+
+    def handle_request_json(self, d_id, s_id, request):
+        # Returns (http status, reply)
+        if not isinstance(request, dict):
+            return 400, {'error': 'request is not a json object'}
+        action = request.get('action')
+        if action not in actions:
+            return 400, {'error': 'unknown action ' + unicode(action)}
+        if action == 'upload' and not isinstance(request.get('tkml', ''), basestring):
+            return 400, {'error': 'tkml is not a string'}
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            self.expire_sessions(now)
+            if action == 'upload':
+                try:
+                    self.scripts[d_id] = TKMLScript(request.get('tkml', ''))
+                except (ET.ParseError, TKMLError) as e:
+                    return 400, {'error': 'tkml not valid: ' + unicode(e)}
+                # Sessions of this dialog restart with the new script
+                for key in [k for k in self.sessions.keys() if k[0] == d_id]:
+                    del self.sessions[key]
+                return 200, {'sayThis': ''}
+            script = self.scripts.get(d_id, self.default_script)
+            if script is None:
+                return 404, {'error': 'no tkml uploaded for ' + d_id}
+            if (d_id, s_id) not in self.sessions.keys() or action == 'start':
+                self.sessions[(d_id, s_id)] = [TKMLSession(script), now]
+            self.sessions[(d_id, s_id)][1] = now
+            session = self.sessions[(d_id, s_id)][0]
+        return 200, session.handle(request)
+
+
+class TalkMLHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive like the live service. The reply is buffered and sent in one write, otherwise
+    # Nagle and delayed acks add ~40 ms to every request
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            status, reply = 400, {'error': 'request not valid json: ' + str(e)}
+        else:
+            try:
+                status, reply = self.server.handle_request_json(self.headers.getheader('DId', ''),
+                                                                self.headers.getheader('SId', ''), request)
+            except Exception as e:
+                # Every request gets a reply, the connection is not left hanging
+                status, reply = 500, {'error': 'server error: ' + repr(e)}
+        self.server.delay()
+        reply['responseCode'] = str(status)
+        reply['version'] = '1.0'
+        data = json.dumps(reply)
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(port=0, latency=0.0, jitter=0.0, tkml=None, session_timeout=600.0):
+    # Serves on its own thread, returns the server and its url
+    server = TalkMLServer(('127.0.0.1', port), latency, jitter, tkml, session_timeout)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:" + str(server.server_address[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local TalkML stand-in server")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help="reply delay in s")
+    parser.add_argument('--jitter', type=float, default=0.0, help="uniform +- jitter added to the delay in s")
+    parser.add_argument('--tkml', default=None, help="script used for every DId that has not uploaded one")
+    parser.add_argument('--session-timeout', type=float, default=600.0, help="idle time in s before a session is dropped")
+    args = parser.parse_args()
+
+    tkml = None
+    if args.tkml is not None:
+        with open(args.tkml) as f:
+            tkml = f.read()
+    server = TalkMLServer(('0.0.0.0', args.port), args.latency, args.jitter, tkml, args.session_timeout)
+    print "TalkML stand-in listening on port", args.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import time
+import threading
+import Queue
+
+
+class TimelineExecutor(object):
+    # Runs a reply as parallel tracks. The lead track (speech) is executed in order on the
+    # calling thread. Every other track has its own worker thread, so a cue placed between two
+    # speech segments starts, after its offset, together with the segment that follows it
+    # instead of holding the speech back.
+    #
+    # A timeline is a list of [track, value, offset] cues in reply order.
+    #
+    # cancel() stops the running timeline: the lead track stops before its next cue and cues
+    # still waiting on other tracks are dropped. Handlers that take time should wait with
+    # sleep() so they are woken by a cancel too. A run started with a token from begin() is
+    # also stopped by a cancel() issued between begin() and run().
+    def __init__(self, lead_track='speech'):
+        self.lead_track = lead_track
+        self.handlers = dict()
+        self.queues = dict()
+        self.threads = dict()
+        self.generation = 0
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_track(self, name, handler):
+        self.handlers[name] = handler
+        if name != self.lead_track:
+            self.queues[name] = Queue.Queue()
+            self.threads[name] = threading.Thread(target=self.track_worker, args=(name,))
+            self.threads[name].daemon = True
+            self.threads[name].start()
+
+    def track_worker(self, name):
+        cues = self.queues[name]
+        while True:
+            cue = cues.get()
+            if cue is None:
+                cues.task_done()
+                break
+            generation, start_time, value = cue
+            if generation == self.generation:
+                self.sleep(start_time - time.time())
+            if generation == self.generation:
+                try:
+                    self.handlers[name](value)
+                except Exception as e:
+                    print "Timeline", name, value, "failed:", e
+            cues.task_done()
+
+    def schedule(self, name, value, offset=0.0):
+        self.queues[name].put((self.generation, time.time() + offset, value))
+
+    def sleep(self, duration):
+        # Returns False when woken early by cancel()
+        if duration > 0:
+            return not self.cancelled.wait(duration)
+        return not self.cancelled.is_set()
+
+    def begin(self):
+        # Token for the next run()
+        return self.generation
+
+    def cancel(self):
+        self.lock.acquire()
+        self.generation += 1
+        self.cancelled.set()
+        self.lock.release()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def run(self, timeline, token=None):
+        # Returns when the lead track is done or cancelled; other tracks may still be running, see wait()
+        self.lock.acquire()
+        if token is None or token == self.generation:
+            self.cancelled.clear()
+        self.lock.release()
+        for track, value, offset in timeline:
+            if self.cancelled.is_set():
+                break
+            if track == self.lead_track:
+                if not self.sleep(offset):
+                    break
+                self.handlers[track](value)
+            elif track in self.queues.keys():
+                self.schedule(track, value, offset)
+            else:
+                print "Timeline track", track, "unknown. Skipping", value
+
+    def wait(self):
+        for name in self.queues.keys():
+            self.queues[name].join()
+
+    def close(self):
+        for name in self.queues.keys():
+            self.queues[name].put(None)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import hashlib
+import urllib
+import requests
+from os.path import join
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pydub import AudioSegment
+
+
+class TTSCache(object):
+    # Tacotron synthesis with a bounded LRU of decoded audio in memory, an optional bounded
+    # cache of wav files on disk, and look-ahead synthesis of upcoming fragments.
+    # Entries are keyed by (voice, text).
+    def __init__(self, url="http://localhost:9000/synthesize", voice="tacotron", max_entries=200,
+                 cache_dir=None, max_disk_entries=2000, max_workers=1, timeout=10.0):
+        self.url = url
+        self.timeout = timeout
+        self.voice = voice
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        # A single worker synthesises look-ahead fragments in the order they will be played
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get_key(self, text):
+        return self.voice, text.strip()
+
+    def get_file(self, key):
+        return join(self.cache_dir, hashlib.sha1('\n'.join(key).encode('utf-8')).hexdigest() + ".wav")
+
+    def get(self, text):
+        key = self.get_key(text)
+        self.lock.acquire()
+        if key in self.entries:
+            self.hits += 1
+            audio = self.entries.pop(key)
+            self.entries[key] = audio
+            self.lock.release()
+            return audio
+        future = self.pending.get(key)
+        if future is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.lock.release()
+
+        if future is not None:
+            return future.result()
+        return self.synthesize(key)
+
+    def prefetch(self, text):
+        key = self.get_key(text)
+        self.lock.acquire()
+        if key not in self.entries and key not in self.pending and key[1] != '':
+            self.pending[key] = self.executor.submit(self.synthesize, key)
+        self.lock.release()
+
+    def synthesize(self, key):
+        try:
+            if self.cache_dir is not None and os.path.isfile(self.get_file(key)):
+                with open(self.get_file(key), 'rb') as f:
+                    audio = AudioSegment.from_file(BytesIO(f.read()), format="wav")
+                # Touching the file keeps the disk cache in least recently used order
+                os.utime(self.get_file(key), None)
+            else:
+                ret = self.session.get(self.url + "?text=" + urllib.quote(key[1]), timeout=self.timeout)
+                if ret.status_code != 200:
+                    raise requests.HTTPError("synthesis failed with status " + str(ret.status_code), response=ret)
+                # Only audio that decodes is written to the disk cache
+                audio = AudioSegment.from_file(BytesIO(ret.content), format="wav")
+                if self.cache_dir is not None:
+                    self.store_file(key, ret.content)
+            self.store(key, audio)
+            return audio
+        finally:
+            self.lock.acquire()
+            self.pending.pop(key, None)
+            self.lock.release()
+
+    def store(self, key, audio):
+        self.lock.acquire()
+        self.entries[key] = audio
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.lock.release()
+
+    def store_file(self, key, wav):
+        with open(self.get_file(key), 'wb') as f:
+            f.write(wav)
+        wav_files = [join(self.cache_dir, x) for x in os.listdir(self.cache_dir) if x.endswith(".wav")]
+        if len(wav_files) > self.max_disk_entries:
+            wav_files.sort(key=os.path.getmtime)
+            for old_file in wav_files[:len(wav_files) - self.max_disk_entries]:
+                os.remove(old_file)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
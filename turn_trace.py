@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# Per-turn latency tracing shared by the modules of the demo. sentence_tokenizer gives every
+# utterance a turn id, which travels as the last string of the bottles that follow from it
+# (classify, spoken, move, ...). Each module records the spans of its own stages under that id.
+#
+# usage: python turn_trace.py trace_file [trace_file ...]
+#   merges the trace files written by the modules and prints per stage percentiles as json
+
+import sys
+import time
+import json
+import uuid
+import threading
+from collections import deque
+
+turn_prefix = 'turn-'
+
+
+def new_turn_id():
+    return turn_prefix + uuid.uuid4().hex[:12]
+
+
+def find_turn_id(bottle):
+    if bottle.size() > 1:
+        value = bottle.get(bottle.size() - 1)
+        if value.isString() and value.asString().startswith(turn_prefix):
+            return value.asString()
+    return None
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def latency_stats(durations):
+    # stage -> count, p50, p95, p99 in seconds
+    result = dict()
+    for stage in durations.keys():
+        values = list(durations[stage])
+        result[stage] = {'count': len(values), 'p50': percentile(values, 50),
+                         'p95': percentile(values, 95), 'p99': percentile(values, 99)}
+    return result
+
+
+class TurnTracer(object):
+    # Keeps the last history durations of every stage for the percentiles. With trace_file set
+    # every span is also appended to it as a json line, see summarize().
+    def __init__(self, module, trace_file=None, history=1000):
+        self.module = module
+        self.history = history
+        self.durations = dict()
+        self.lock = threading.Lock()
+        self.trace_file = None
+        if trace_file is not None:
+            self.trace_file = open(trace_file, 'a')
+
+    def record(self, turn_id, stage, start, end=None):
+        if end is None:
+            end = time.time()
+        self.lock.acquire()
+        if stage not in self.durations.keys():
+            self.durations[stage] = deque(maxlen=self.history)
+        self.durations[stage].append(end - start)
+        if self.trace_file is not None:
+            self.trace_file.write(json.dumps({'module': self.module, 'turn': turn_id, 'stage': stage,
+                                              'start': start, 'duration': end - start}) + '\n')
+            self.trace_file.flush()
+        self.lock.release()
+
+    def span(self, turn_id, stage):
+        return TraceSpan(self, turn_id, stage)
+
+    def stats(self):
+        self.lock.acquire()
+        result = latency_stats(self.durations)
+        self.lock.release()
+        return result
+
+    def add_stats(self, reply):
+        # ack (stage count p50 p95 p99) ...
+        reply.addString('ack')
+        stats = self.stats()
+        for stage in sorted(stats.keys()):
+            stage_bottle = reply.addList()
+            stage_bottle.addString(stage)
+            stage_bottle.addInt(stats[stage]['count'])
+            for k in ['p50', 'p95', 'p99']:
+                stage_bottle.addDouble(stats[stage][k])
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+
+class TraceSpan(object):
+    def __init__(self, tracer, turn_id, stage):
+        self.tracer = tracer
+        self.turn_id = turn_id
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.turn_id, self.stage, self.start)
+        return False
+
+
+def summarize(trace_files):
+    # Per stage percentiles over all files, plus the time from the first span of a turn to the
+    # end of its last span as stage 'turn'
+    durations = dict()
+    turns = dict()
+    for trace_file in trace_files:
+        with open(trace_file) as f:
+            for line in f:
+                span = json.loads(line)
+                durations.setdefault(span['stage'], []).append(span['duration'])
+                if span['turn'] is not None:
+                    start, end = turns.get(span['turn'], (span['start'], span['start']))
+                    turns[span['turn']] = (min(start, span['start']),
+                                           max(end, span['start'] + span['duration']))
+    durations['turn'] = [end - start for start, end in turns.values()]
+    return latency_stats(durations)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "usage: python turn_trace.py trace_file [trace_file ...]"
+        sys.exit(1)
+    print json.dumps(summarize(sys.argv[1:]), indent=2, sort_keys=True)